@@ -30,4 +30,10 @@ CREATE TABLE Appointments (
     PUsername varchar(255) REFERENCES Patients,
     Username varchar(255) REFERENCES Caregivers,
     PRIMARY KEY (appointmentID)
-);
\ No newline at end of file
+);
+
+CREATE TABLE Sequences (
+    Name varchar(255),
+    NextValue int,
+    PRIMARY KEY (Name)
+);
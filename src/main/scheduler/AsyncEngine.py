@@ -0,0 +1,92 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+import Server
+from model.Appointment import Appointment
+from model.Caregiver import Caregiver
+from model.Patient import Patient
+from model.Vaccine import Vaccine
+from util.Session import install_session_stdout
+
+
+class EngineOverloaded(Exception):
+    pass
+
+
+class AsyncEngine:
+    '''
+    Runs Scheduler operations from asyncio code.
+
+    The models block on the database driver, so each operation runs on a
+    bounded thread pool (max_workers, by default the size of the connection
+    pool) while the event loop keeps going; thousands of searches and
+    reservations can be in flight while only max_workers wait on the
+    database at a time.
+
+    Backpressure: at most max_in_flight operations are admitted at once,
+    counting queued and running ones. An operation that cannot be admitted
+    and finished within its timeout raises EngineOverloaded or
+    asyncio.TimeoutError. A timeout stops the caller waiting; an operation
+    already running on the database still finishes (and commits) on its
+    worker, and only then frees its slot.
+
+        engine = AsyncEngine()
+        appointment = await engine.reserve("alice", date, "pfizer", timeout=2)
+    '''
+
+    def __init__(self, max_workers=None, max_in_flight=None, timeout=None):
+        self.max_workers = max_workers or int(os.getenv("PoolMaxSize", "10"))
+        self.max_in_flight = max_in_flight or int(os.getenv("EngineMaxInFlight", "1000"))
+        self.timeout = timeout or float(os.getenv("EngineTimeout", "30"))
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="engine")
+        self._slots = None
+
+    async def call(self, fn, *args, timeout=None):
+        # run fn(*args) on a worker and await its result
+        loop = asyncio.get_running_loop()
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+        deadline = loop.time() + (timeout or self.timeout)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), deadline - loop.time())
+        except asyncio.TimeoutError:
+            raise EngineOverloaded("Too many requests in flight, try again later")
+
+        future = loop.run_in_executor(self.executor, fn, *args)
+        # the slot is only free again once the worker is done, even after a timeout
+        future.add_done_callback(lambda _: self._slots.release())
+        return await asyncio.wait_for(asyncio.shield(future), max(deadline - loop.time(), 0))
+
+    async def login(self, role, username, password, timeout=None):
+        cls = Patient if role == "patient" else Caregiver
+        return await self.call(cls(username, password=password).get, timeout=timeout)
+
+    async def search(self, date, timeout=None):
+        return await self.call(Caregiver(None).get_availability, date, timeout=timeout)
+
+    async def search_range(self, start, end, timeout=None):
+        return await self.call(lambda: list(Caregiver.get_availability_range(start, end)), timeout=timeout)
+
+    async def vaccines(self, timeout=None):
+        return await self.call(Vaccine.get_all, timeout=timeout)
+
+    async def reserve(self, patient, date, vaccine_name, caregiver=None, timeout=None):
+        return await self.call(Appointment.reserve, patient, date, vaccine_name, caregiver, timeout=timeout)
+
+    async def reserve_batch(self, requests, timeout=None):
+        return await self.call(Appointment.reserve_batch, requests, timeout=timeout)
+
+    async def show_appointments(self, role, username, timeout=None):
+        return await self.call(Appointment.get_appointments, role, username, timeout=timeout)
+
+    async def add_doses(self, doses, timeout=None):
+        return await self.call(Vaccine.add_doses, doses, timeout=timeout)
+
+    async def run_command(self, session, line, timeout=None):
+        # run a command line as session, like a Server client would; returns
+        # (output, keep_going)
+        install_session_stdout()
+        return await self.call(Server.run_command, session, line, timeout=timeout)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -3,19 +3,45 @@ from model.Caregiver import Caregiver
 from model.Patient import Patient
 from model.Appointment import Appointment
 from util.Util import Util
+from util.PasswordHasher import get_hasher
+from util.Session import current_session, install_session_stdout
+from util.Metrics import get_metrics
 from db.ConnectionManager import ConnectionManager
-import pymssql
+from db.Migrations import migrate
+from db.SessionStore import get_session_store
+from db.QueryTrace import get_tracer
+from db.Backend import DBError, DBIntegrityError
+import argparse
 import datetime
+import os
+import sys
+import time
+from contextlib import closing
 
 
 '''
-objects to keep track of the currently logged-in user
-Note: it is always true that at most one of currentCaregiver and currentPatient is not null
-        since only one user can be logged-in at a time
+The currently logged-in user is kept on the Session returned by
+current_session(), see util/Session.py
 '''
-current_patient = None
 
-current_caregiver = None
+# Where the file commands (provision_users, import_doses, reserve_batch) may
+# read from. None, run locally, means anywhere the user can read. Server.py
+# sets it to its --import-dir, since its clients' paths are opened on the
+# server: "" refuses the file commands, otherwise paths are taken relative to
+# that directory and may not leave it.
+import_dir = None
+
+
+def import_path(path):
+    if import_dir is None:
+        return path
+    if not import_dir:
+        raise ValueError("File commands are disabled on this server")
+    root = os.path.realpath(import_dir)
+    full = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, full]) != root:
+        raise ValueError("Files must be in the server's import directory")
+    return full
 
 
 def create_patient(tokens):
@@ -25,21 +51,21 @@ def create_patient(tokens):
 
     username = tokens[1]
     password = tokens[2]
-    # check 2: check if the username has been taken already
-    if username_exists_patient(username):
-        print("Username taken, try again!")
-        return
-
     salt = Util.generate_salt()
-    hash = Util.generate_hash(password, salt)
+    hasher = get_hasher()
+    hash = hasher.hash(password, salt)
 
     # create the caregiver
-    patient = Patient(username, salt=salt, hash=hash)
+    patient = Patient(username, salt=salt, hash=hash, hash_params=hasher.params)
 
-    # save to caregiver information to our database
+    # save to caregiver information to our database; a taken username is
+    # reported by the insert itself
     try:
         patient.save_to_db()
-    except pymssql.Error as e:
+    except DBIntegrityError:
+        print("Username taken, try again!")
+        return
+    except DBError as e:
         print("Failed to create user.")
         print("Db-Error:", e)
         print("Please try again!")
@@ -52,31 +78,6 @@ def create_patient(tokens):
     print("Created user ", username)
 
 
-def username_exists_patient(username):
-    cm = ConnectionManager()
-    conn = cm.create_connection()
-
-    select_username = "SELECT * FROM Patients WHERE PUsername = %s"
-    try:
-        cursor = conn.cursor(as_dict=True)
-        cursor.execute(select_username, username)
-        #  returns false if the cursor is not before the first record or if there are no rows in the ResultSet.
-        for row in cursor:
-            return row['Username'] is not None
-    except pymssql.Error as e:
-        print("Error occurred when checking username")
-        print("Db-Error:", e)
-        print("Please try again!")
-        quit()
-    except Exception as e:
-        print("Error occurred when checking username")
-        print("Error:", e)
-        print("Please try again!")
-    finally:
-        cm.close_connection()
-    return False
-
-
 def create_caregiver(tokens):
     # create_caregiver <username> <password>
     # check 1: the length for tokens need to be exactly 3 to include all information (with the operation name)
@@ -86,21 +87,21 @@ def create_caregiver(tokens):
 
     username = tokens[1]
     password = tokens[2]
-    # check 2: check if the username has been taken already
-    if username_exists_caregiver(username):
-        print("Username taken, try again!")
-        return
-
     salt = Util.generate_salt()
-    hash = Util.generate_hash(password, salt)
+    hasher = get_hasher()
+    hash = hasher.hash(password, salt)
 
     # create the caregiver
-    caregiver = Caregiver(username, salt=salt, hash=hash)
+    caregiver = Caregiver(username, salt=salt, hash=hash, hash_params=hasher.params)
 
-    # save to caregiver information to our database
+    # save to caregiver information to our database; a taken username is
+    # reported by the insert itself
     try:
         caregiver.save_to_db()
-    except pymssql.Error as e:
+    except DBIntegrityError:
+        print("Username taken, try again!")
+        return
+    except DBError as e:
         print("Failed to create user.")
         print("Db-Error:", e)
         print("Please try again!")
@@ -113,36 +114,72 @@ def create_caregiver(tokens):
     print("Created user ", username)
 
 
-def username_exists_caregiver(username):
-    cm = ConnectionManager()
-    conn = cm.create_connection()
+def parse_roster_row(row):
+    # (role, username, password) from a "role,username,password" csv row.
+    # Lowercased like everything typed into the command line, so the
+    # accounts can log in from it.
+    if len(row) != 3 or row[0].strip().lower() not in ("patient", "caregiver") or not row[1].strip():
+        raise ValueError("Malformed row")
+    return row[0].strip().lower(), row[1].strip().lower(), row[2].strip().lower()
 
-    select_username = "SELECT * FROM Caregivers WHERE Username = %s"
+
+def provision_users(tokens):
+    #  provision_users <file.csv> [<batch_size>]
+    session = current_session()
+    #  check 1: check if the current logged-in user is a caregiver
+    if session.caregiver is None:
+        print("Please login as a caregiver first!")
+        return
+
+    #  check 2: the length for tokens need to be 2 or 3
+    if len(tokens) not in (2, 3):
+        print("Please try again!")
+        return
+
+    rows = 0
+    created = 0
+    start_time = time.perf_counter()
+    hasher = get_hasher()
     try:
-        cursor = conn.cursor(as_dict=True)
-        cursor.execute(select_username, username)
-        #  returns false if the cursor is not before the first record or if there are no rows in the ResultSet.
-        for row in cursor:
-            return row['Username'] is not None
-    except pymssql.Error as e:
-        print("Error occurred when checking username")
+        batch_size = int(tokens[2]) if len(tokens) == 3 else 500
+        if batch_size <= 0:
+            raise ValueError("The batch size must be positive")
+        for batch in Util.read_csv_batches(import_path(tokens[1]), batch_size, parse_roster_row, ("role",)):
+            # hash the whole batch in parallel on the hasher's worker pool
+            salts = [Util.generate_salt() for _ in batch]
+            hashes = hasher.map([(password, salt) for (_, _, password), salt in zip(batch, salts)])
+            patients = []
+            caregivers = []
+            for (role, username, _), salt, hash in zip(batch, salts, hashes):
+                if role == "patient":
+                    patients.append(Patient(username, salt=salt, hash=hash, hash_params=hasher.params))
+                else:
+                    caregivers.append(Caregiver(username, salt=salt, hash=hash, hash_params=hasher.params))
+            if patients:
+                created += Patient.save_all(patients)
+            if caregivers:
+                created += Caregiver.save_all(caregivers)
+            rows += len(batch)
+    except DBError as e:
+        print("Provisioning failed after", rows, "rows")
         print("Db-Error:", e)
         print("Please try again!")
-        quit()
+        return
     except Exception as e:
-        print("Error occurred when checking username")
+        print("Provisioning failed after", rows, "rows")
         print("Error:", e)
         print("Please try again!")
-    finally:
-        cm.close_connection()
-    return False
+        return
+    elapsed = time.perf_counter() - start_time
+    print("Created {created} of {rows} users ({skipped} usernames taken) in {elapsed:.3f}s ({rate:.0f} users/s)".format(
+        created=created, rows=rows, skipped=rows - created, elapsed=elapsed, rate=rows / elapsed if elapsed > 0 else 0))
 
 
 def login_patient(tokens):
     # login_patient <username> <password>
+    session = current_session()
     # check 1: if someone's already logged-in, they need to log out first
-    global current_patient
-    if current_caregiver is not None or current_patient is not None:
+    if session.caregiver is not None or session.patient is not None:
         print("User already logged in.")
         return
 
@@ -157,7 +194,7 @@ def login_patient(tokens):
     patient = None
     try:
         patient = Patient(username, password=password).get()
-    except pymssql.Error as e:
+    except DBError as e:
         print("Login failed.")
         print("Db-Error:", e)
         print("Please try again!")
@@ -173,14 +210,15 @@ def login_patient(tokens):
         print("Login failed.")
     else:
         print("Logged in as: " + username)
-        current_patient = patient
+        session.patient = patient
+        start_session("patient", username)
 
 
 def login_caregiver(tokens):
     # login_caregiver <username> <password>
+    session = current_session()
     # check 1: if someone's already logged-in, they need to log out first
-    global current_caregiver
-    if current_caregiver is not None or current_patient is not None:
+    if session.caregiver is not None or session.patient is not None:
         print("User already logged in.")
         return
 
@@ -195,7 +233,7 @@ def login_caregiver(tokens):
     caregiver = None
     try:
         caregiver = Caregiver(username, password=password).get()
-    except pymssql.Error as e:
+    except DBError as e:
         print("Login failed.")
         print("Db-Error:", e)
         print("Please try again!")
@@ -211,15 +249,76 @@ def login_caregiver(tokens):
         print("Login failed.")
     else:
         print("Logged in as: " + username)
-        current_caregiver = caregiver
+        session.caregiver = caregiver
+        start_session("caregiver", username)
+
+
+def start_session(role, username):
+    # issue a token so the login can be resumed without the password
+    session = current_session()
+    try:
+        session.token = get_session_store().issue(role, username)
+    except DBError as e:
+        print("Could not create a session token")
+        print("Db-Error:", e)
+        return
+    print("Session token: " + session.token)
+
+
+def resume(tokens):
+    # resume <token>
+    session = current_session()
+    if session.caregiver is not None or session.patient is not None:
+        print("User already logged in.")
+        return
+
+    if len(tokens) != 2:
+        print("Login failed.")
+        return
+
+    try:
+        stored = get_session_store().lookup(tokens[1])
+    except DBError as e:
+        print("Login failed.")
+        print("Db-Error:", e)
+        print("Please try again!")
+        return
+
+    if stored is None:
+        print("Session expired or unknown, please log in again.")
+        return
+    role, username = stored
+    if role == "patient":
+        session.patient = Patient(username)
+    else:
+        session.caregiver = Caregiver(username)
+    session.token = tokens[1]
+    print("Logged in as: " + username)
 
 
 def search_caregiver_schedule(tokens):
+    session = current_session()
     # check 1: Insure they are logged in
-    if not((current_caregiver != None) or (current_patient != None)):
+    if not((session.caregiver != None) or (session.patient != None)):
         print("Please log in first.")
         return
 
+    # search_caregiver_schedule <start_date> <end_date>
+    # search_caregiver_schedule next <days>
+    if len(tokens) == 3:
+        try:
+            if tokens[1] == "next":
+                start = datetime.datetime.combine(datetime.date.today(), datetime.time())
+                end = start + datetime.timedelta(days=int(tokens[2]) - 1)
+            else:
+                start = Util.parse_date(tokens[1])
+                end = Util.parse_date(tokens[2])
+        except ValueError:
+            print("Please try again!")
+            return
+        search_caregiver_schedule_range(start, end)
+        return
+
     # check 2: The number of tokens should be 2
     if len(tokens) != 2:
         print("Please try again!")
@@ -236,7 +335,7 @@ def search_caregiver_schedule(tokens):
     try:
         date = datetime.datetime(year, month, day)
         avaliableDates = Caregiver(date).get_availability(date)
-    except pymssql.Error as e:
+    except DBError as e:
         print("Please try again!")
         return
     except ValueError:
@@ -257,37 +356,86 @@ def search_caregiver_schedule(tokens):
             print(date, end=" ")
         
         # Prints vaccines
-        cm = ConnectionManager()
-        conn = cm.create_connection()
-        cursor = conn.cursor()
-
-        get_vaccine = "SELECT * FROM Vaccines"
         print("========Avaliable Vaccines========")
         try:
-            cursor.execute(get_vaccine)
-            for row in cursor:
-                print(str(row[0]) + ": " + str(row[1]))
-        except pymssql.Error:
+            for name, doses in Vaccine.get_all():
+                print(str(name) + ": " + str(doses))
+        except DBError:
             # print("Error occurred when getting Vaccine")
             print("Please try again!")
             raise
-        finally:
-            cm.close_connection()
         return None
 
 
+def search_caregiver_schedule_range(start, end):
+    # one line per day with free caregivers, printed as the rows come in
+    days = 0
+    try:
+        for day, usernames in Caregiver.get_availability_range(start, end):
+            if days == 0:
+                print("Schedule search successful.")
+            print("{day}: {count} available - {names}".format(day=day, count=len(usernames), names=" ".join(usernames)))
+            days += 1
+    except DBError as e:
+        print("Please try again!")
+        return
+    if days == 0:
+        print("No available caregivers found for those dates")
+
+
+def first_available(tokens):
+    # first_available <vaccine> [<start_date>]
+    session = current_session()
+    if not((session.caregiver != None) or (session.patient != None)):
+        print("Please log in first.")
+        return
+
+    if len(tokens) not in (2, 3):
+        print("Please try again!")
+        return
+
+    try:
+        vaccine = Vaccine(tokens[1], None).get()
+        if vaccine is None or vaccine.get_available_doses() <= 0:
+            print("No doses of " + tokens[1] + " available")
+            return
+        if len(tokens) == 3:
+            start = Util.parse_date(tokens[2])
+        else:
+            start = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        # stop reading after the first day that has anyone free
+        days = Caregiver.get_availability_range(start, datetime.datetime.max)
+        try:
+            found = next(days, None)
+        finally:
+            days.close()
+    except DBError as e:
+        print("Please try again!")
+        return
+    except ValueError:
+        print("Please try again!")
+        return
+
+    if found is None:
+        print("No available caregivers found")
+    else:
+        day, usernames = found
+        print("First available date for {vaccine}: {day} ({count} available - {names})".format(
+            vaccine=tokens[1], day=day, count=len(usernames), names=" ".join(usernames)))
+
 
 def reserve(tokens):
+    session = current_session()
     # check 1: Insure they are logged in
-    if ((current_caregiver == None) and (current_patient == None)):
+    if ((session.caregiver == None) and (session.patient == None)):
         print("Please login first!")
         return
-    elif current_patient == None:
+    elif session.patient == None:
         print("Please login as a patient!")
         return
 
-    # check 2: The number of tokens should be 3
-    if len(tokens) != 3:
+    # check 2: The number of tokens should be 3, or 4 with a caregiver
+    if len(tokens) not in (3, 4):
         print("Reservation failed.")
         print("Incorrect number of inputs")
         return
@@ -299,122 +447,70 @@ def reserve(tokens):
     day = int(date_tokens[1])
     year = int(date_tokens[2])
     Dose_name = tokens[2]
-    # Find the available caregivers on the date
+    caregiver = tokens[3] if len(tokens) == 4 else None
     try:
         date = datetime.datetime(year, month, day)
-        avaliableCaregiver = Caregiver(date).get_availability(date)
-    except pymssql.Error as e:
-        print("Fetchings schedule failed.")
-        print("Db-Error:", e)
-        print("Please try again!")
-        return
     except ValueError:
         print("Please enter a valid date!")
         print("Please try again!")
         return
+
+    # Pick a caregiver, use up a dose and book the appointment in one transaction
+    try:
+        newAppointment = Appointment.reserve(session.patient.username, date, Dose_name, caregiver)
+    except DBError as e:
+        print("Error occurred when creating appointment")
+        print("Db-Error:", e)
+        print("Please try again!")
+        return
+    except ValueError as e:
+        print("Reservation failed.")
+        print(e)
+        return
     except Exception as e:
-        print("Error occurred when fetching availability")
+        print("Error occurred when creating appointment")
         print("Check your input and try again.")
         print(e)
         print("Please try again!")
         return
-    
-    if avaliableCaregiver==[]:
-        print("No available caregivers found for that date")
-        return
-    else:    
-        freeCaregiver = avaliableCaregiver[0] 
 
-        # Get the appointment id
-        cm = ConnectionManager()
-        conn = cm.create_connection()
-        cursor = conn.cursor()
-
-        get_appointment_id = "SELECT COUNT(appointmentID) FROM Appointments "
-        try:
-            cm = ConnectionManager()
-            conn = cm.create_connection()
-            cursor = conn.cursor()
-            cursor.execute(get_appointment_id)
-            for row in cursor:
-                id = row
-        except pymssql.Error as e:
-            print("Error occurred when getting appointment ID")
-            print("Db-Error:", e)
-            print("Please try again!")
-            raise e
-        
-
-        # Reduce the vaccine count
-        cm = ConnectionManager()
-        conn = cm.create_connection()
-        cursor = conn.cursor()
-        get_vaccine_count = "SELECT Doses, Doses FROM Vaccines WHERE Name = %s"
-        get_vaccine = "UPDATE Vaccines SET Doses = %s WHERE name = %s"
-        try:
-            cursor.execute(get_vaccine_count, (Dose_name))
-            for row in cursor:
-                count = row[0] - 1
-            cursor.execute(get_vaccine, (count, Dose_name))
-            conn.commit()
-            if cursor.rowcount == 0:
-                print("No such vaccine")
-                return
-        except pymssql.Error:
-            # print("Error occurred when getting Vaccine")
-            print("Please try again!")
-            raise
-        finally:
-            cm.close_connection()
-        
-        # Create the appointment
-        try:
-            newAppointment = Appointment(id, current_patient.username, freeCaregiver, date) # Creates the appointment
-            newAppointment.create() # Adds the appointment to the database
-        except pymssql.Error as e:
-            print("Error occurred when creating appointment")
-            print("Db-Error:", e)
-            print("Please try again!")
-        except Exception as e:
-            print("Error occurred when creating appointment")
-            print("Check your input and try again.")
-            print(e)
-            print("Please try again!")
-            return
-        finally:
-            cm.close_connection()
-
-        print("“Appointment ID: {appointment_id}, Caregiver username: {username}".format(appointment_id=str(id).strip("(),"), username=freeCaregiver))
+    print("“Appointment ID: {appointment_id}, Caregiver username: {username}".format(appointment_id=newAppointment.id, username=newAppointment.caregiver))
 
 def upload_availability(tokens):
     #  upload_availability <date>
+    #  upload_availability <start_date> <end_date> [daily | weekdays | weekends | mon,wed,fri]
+    session = current_session()
     #  check 1: check if the current logged-in user is a caregiver
-    global current_caregiver
-    if current_caregiver is None:
+    if session.caregiver is None:
         print("Please login as a caregiver first!")
         return
 
-    # check 2: the length for tokens need to be exactly 2 to include all information (with the operation name)
-    if len(tokens) != 2:
+    # check 2: the length for tokens need to be 2 for one date, or 3-4 for a range
+    if len(tokens) not in (2, 3, 4):
         print("Please try again!")
         return
 
-    date = tokens[1]
-    # assume input is hyphenated in the format mm-dd-yyyy
-    date_tokens = date.split("-")
-    month = int(date_tokens[0])
-    day = int(date_tokens[1])
-    year = int(date_tokens[2])
     try:
-        d = datetime.datetime(year, month, day)
-        current_caregiver.upload_availability(d)
-    except pymssql.Error as e:
+        weekdays = Util.parse_weekdays(tokens[3]) if len(tokens) > 3 else None
+    except ValueError as e:
+        print("Please enter valid days of the week!")
+        print(e)
+        print("Please try again!")
+        return
+
+    try:
+        start = Util.parse_date(tokens[1])
+        end = Util.parse_date(tokens[2]) if len(tokens) > 2 else start
+        dates = Util.date_range(start, end, weekdays)
+        uploaded = session.caregiver.upload_availabilities(dates)
+    except DBError as e:
         print("Upload Availability Failed")
         print("Db-Error:", e)
         print("Please try again!")
         quit()
-    except ValueError:
+    except ValueError as e:
         print("Please enter a valid date!")
+        print(e)
         print("Please try again!")
         return
     except Exception as e:
@@ -423,55 +519,118 @@ def upload_availability(tokens):
         print("Please try again!")
         return
     print("Availability uploaded!")
+    if len(dates) > 1:
+        print("{uploaded} of {total} days added, the rest were already uploaded".format(uploaded=uploaded, total=len(dates)))
 
 
 def cancel(tokens):
+    session = current_session()
     if len(tokens) != 2:
         print("Please try again!")
         return
 
     # check 1: check if the current logged-in 
-    if ((current_caregiver == None) and (current_patient == None)):
+    if ((session.caregiver == None) and (session.patient == None)):
         print("Please login first!")
         return
 
-    id = tokens[1]
-
-    cm = ConnectionManager()
-    conn = cm.create_connection()
-    cursor = conn.cursor()
-
-    upcomingAppointments = "DELETE FROM Appointments WHERE appointmentID = %s AND (PUsername = %s OR Username = %s)"
     try:
-        if current_patient is None:
-            patient = 'null'
-            caregiver = current_caregiver.username
-        else:
-            patient = current_patient.username
-            caregiver = 'null'
+        id = int(tokens[1])
+    except ValueError:
+        print("Please enter a valid appointment ID!")
+        return
 
-        cursor.execute(upcomingAppointments, (id, patient, caregiver))
+    if session.patient is None:
+        role, username = "caregiver", session.caregiver.username
+    else:
+        role, username = "patient", session.patient.username
 
-        for row in cursor:
-            for i in row:
-                print(i,end=" ")
-            print()
-    except pymssql.Error:
+    # deletes it, gives its dose back and frees the caregiver on that date
+    try:
+        appointment = Appointment.cancel(id, role, username)
+    except DBError:
         # print("Error occurred when getting Vaccine")
         print("Please try again!")
         raise
-    finally:
-        conn.commit()
-        cm.close_connection()
-        print("Appointment cancelled!")
+    if appointment is None:
+        print("Cancellation failed.")
+        print("No appointment with that ID found")
+        return
+    print("Appointment cancelled!")
     return None
 
 
+def is_admin(username):
+    # caregivers named in AdminCaregivers (comma-separated) may act for others
+    return username in {name.strip().lower() for name in os.getenv("AdminCaregivers", "").split(",") if name.strip()}
+
+
+def cancel_caregiver(tokens):
+    #  cancel_caregiver <caregiver> <start_date> [<end_date>]
+    session = current_session()
+    if session.caregiver is None:
+        print("Please login as a caregiver first!")
+        return
+
+    if len(tokens) not in (3, 4):
+        print("Please try again!")
+        return
+
+    # caregiver accounts are self-service, so only admins may clear another
+    # caregiver's schedule
+    if tokens[1] != session.caregiver.username and not is_admin(session.caregiver.username):
+        print("You can only cancel your own appointments!")
+        return
+
+    try:
+        start = Util.parse_date(tokens[2])
+        end = Util.parse_date(tokens[3]) if len(tokens) == 4 else start
+        if end < start:
+            raise ValueError("The end date must not be before the start date")
+    except ValueError as e:
+        print("Please enter a valid date!")
+        print(e)
+        return
+
+    start_time = time.perf_counter()
+    try:
+        result = Appointment.cancel_caregiver(tokens[1], start, end)
+    except DBError as e:
+        print("Error occurred when cancelling appointments")
+        print("Db-Error:", e)
+        print("Please try again!")
+        return
+    except Exception as e:
+        print("Error occurred when cancelling appointments")
+        print("Error:", e)
+        print("Please try again!")
+        return
+    elapsed = time.perf_counter() - start_time
+    if result is None:
+        print("No such caregiver:", tokens[1])
+        return
+    moved, cancelled, given_back = result
+
+    for appointment in moved:
+        print("Appointment ID: {id}, Patient: {patient}, {date}: moved to caregiver {caregiver}".format(
+            id=appointment.id, patient=appointment.patient, date=appointment.date, caregiver=appointment.caregiver))
+    for appointment in cancelled:
+        print("Appointment ID: {id}, Patient: {patient}, {date}: cancelled, no other caregiver available".format(
+            id=appointment.id, patient=appointment.patient, date=appointment.date))
+    total = len(moved) + len(cancelled)
+    print("{total} appointments of {caregiver}: {moved} moved, {cancelled} cancelled".format(
+        total=total, caregiver=tokens[1], moved=len(moved), cancelled=len(cancelled)))
+    if given_back:
+        print("Doses given back:", ", ".join("{0} {1}".format(name, n) for name, n in sorted(given_back.items())))
+    print("Done in {elapsed:.3f}s ({rate:.0f} appointments/s)".format(
+        elapsed=elapsed, rate=total / elapsed if elapsed > 0 else 0))
+
+
 def add_doses(tokens):
     #  add_doses <vaccine> <number>
+    session = current_session()
     #  check 1: check if the current logged-in user is a caregiver
-    global current_caregiver
-    if current_caregiver is None:
+    if session.caregiver is None:
         print("Please login as a caregiver first!")
         return
 
@@ -480,12 +639,13 @@ def add_doses(tokens):
         print("Please try again!")
         return
 
-    vaccine_name = tokens[1]
-    doses = int(tokens[2])
-    vaccine = None
+    # adds the vaccine if it is not in the database yet, else adds to its doses
     try:
-        vaccine = Vaccine(vaccine_name, doses).get()
-    except pymssql.Error as e:
+        vaccine_name = tokens[1]
+        doses = int(tokens[2])
+        Vaccine.add_doses([(vaccine_name, doses)])
+    except DBError as e:
+        print("Error occurred when adding doses")
         print("Db-Error:", e)
         print("Please try again!")
         quit()
@@ -494,160 +654,457 @@ def add_doses(tokens):
         print("Error:", e)
         print("Please try again!")
         return
+    print("Doses updated!")
 
-    # if the vaccine is not found in the database, add a new (vaccine, doses) entry.
-    # else, update the existing entry by adding the new doses
-    if vaccine is None:
-        vaccine = Vaccine(vaccine_name, doses)
-        try:
-            vaccine.save_to_db()
-        except pymssql.Error as e:
-            print("Error occurred when adding doses")
-            print("Db-Error:", e)
-            print("Please try again!")
-            quit()
-        except Exception as e:
-            print("Error occurred when adding doses")
-            print("Error:", e)
-            print("Please try again!")
-            return
-    else:
-        # if the vaccine is not null, meaning that the vaccine already exists in our table
-        try:
-            vaccine.increase_available_doses(doses)
-        except pymssql.Error as e:
-            print("Error occurred when adding doses")
-            print("Db-Error:", e)
-            print("Please try again!")
-            quit()
-        except Exception as e:
-            print("Error occurred when adding doses")
-            print("Error:", e)
-            print("Please try again!")
-            return
+
+def stripe_vaccine(tokens):
+    #  stripe_vaccine <vaccine> <stripes>
+    session = current_session()
+    if session.caregiver is None:
+        print("Please login as a caregiver first!")
+        return
+
+    if len(tokens) != 3:
+        print("Please try again!")
+        return
+
+    try:
+        vaccine_name = tokens[1]
+        stripes = int(tokens[2])
+        total = Vaccine.set_stripes(vaccine_name, stripes)
+    except DBError as e:
+        print("Error occurred when striping vaccine")
+        print("Db-Error:", e)
+        print("Please try again!")
+        quit()
+    except Exception as e:
+        print("Error occurred when striping vaccine")
+        print("Error:", e)
+        print("Please try again!")
+        return
+    print("{vaccine}: {total} doses over {stripes} stripes".format(vaccine=vaccine_name, total=total, stripes=stripes))
+
+
+def parse_dose_row(row):
+    # (vaccine, doses) from a "vaccine,doses" csv row
+    doses = int(row[1])
+    if doses <= 0:
+        raise ValueError("Argument cannot be negative!")
+    return row[0].strip().lower(), doses
+
+
+def import_doses(tokens):
+    #  import_doses <file.csv> [<batch_size>]
+    session = current_session()
+    #  check 1: check if the current logged-in user is a caregiver
+    if session.caregiver is None:
+        print("Please login as a caregiver first!")
+        return
+
+    #  check 2: the length for tokens need to be 2 or 3
+    if len(tokens) not in (2, 3):
+        print("Please try again!")
+        return
+
+    rows = 0
+    batches = 0
+    start_time = time.perf_counter()
+    try:
+        batch_size = int(tokens[2]) if len(tokens) == 3 else 1000
+        if batch_size <= 0:
+            raise ValueError("The batch size must be positive")
+        # each batch is committed on its own, so a failure keeps the batches before it
+        for batch in Util.read_csv_batches(import_path(tokens[1]), batch_size, parse_dose_row, ("vaccine", "name")):
+            Vaccine.add_doses(batch)
+            rows += len(batch)
+            batches += 1
+    except DBError as e:
+        print("Import failed after", rows, "rows")
+        print("Db-Error:", e)
+        print("Please try again!")
+        return
+    except Exception as e:
+        print("Import failed after", rows, "rows")
+        print("Error:", e)
+        print("Please try again!")
+        return
+    elapsed = time.perf_counter() - start_time
     print("Doses updated!")
+    print("{rows} rows in {batches} batches in {elapsed:.3f}s ({rate:.0f} rows/s)".format(
+        rows=rows, batches=batches, elapsed=elapsed, rate=rows / elapsed if elapsed > 0 else 0))
+
+
+def parse_reservation_row(row):
+    # (patient, date, vaccine) from a "patient,date,vaccine" csv row
+    return row[0].strip().lower(), Util.parse_date(row[1].strip()), row[2].strip().lower()
+
+
+def reserve_batch(tokens):
+    #  reserve_batch <file.csv> [<batch_size>]
+    session = current_session()
+    #  check 1: booking for others is for caregivers
+    if session.caregiver is None:
+        print("Please login as a caregiver first!")
+        return
+
+    #  check 2: the length for tokens need to be 2 or 3
+    if len(tokens) not in (2, 3):
+        print("Please try again!")
+        return
+
+    requests = 0
+    reserved = 0
+    batches = 0
+    start_time = time.perf_counter()
+    try:
+        batch_size = int(tokens[2]) if len(tokens) == 3 else 1000
+        if batch_size <= 0:
+            raise ValueError("The batch size must be positive")
+        # each batch is one transaction, so a failure keeps the batches before it
+        for batch in Util.read_csv_batches(import_path(tokens[1]), batch_size, parse_reservation_row, ("patient", "username")):
+            results = Appointment.reserve_batch(batch)
+            for (patient, date, vaccine_name), result in zip(batch, results):
+                if isinstance(result, Appointment):
+                    reserved += 1
+                    print("{patient} {date} {vaccine}: Appointment ID: {id}, Caregiver username: {caregiver}".format(
+                        patient=patient, date=date.strftime("%m-%d-%Y"), vaccine=vaccine_name,
+                        id=result.id, caregiver=result.caregiver))
+                else:
+                    print("{patient} {date} {vaccine}: Reservation failed. {reason}".format(
+                        patient=patient, date=date.strftime("%m-%d-%Y"), vaccine=vaccine_name, reason=result))
+            requests += len(batch)
+            batches += 1
+    except DBError as e:
+        print("Batch reservation failed after", requests, "requests")
+        print("Db-Error:", e)
+        print("Please try again!")
+        return
+    except Exception as e:
+        print("Batch reservation failed after", requests, "requests")
+        print("Error:", e)
+        print("Please try again!")
+        return
+    elapsed = time.perf_counter() - start_time
+    print("{reserved} of {requests} requests reserved in {batches} batches in {elapsed:.3f}s ({rate:.0f} requests/s)".format(
+        reserved=reserved, requests=requests, batches=batches, elapsed=elapsed,
+        rate=requests / elapsed if elapsed > 0 else 0))
 
 
 def show_appointments(tokens):
+    #  show_appointments [upcoming | <start_date> [<end_date>] | more]
+    session = current_session()
     # First check if there are the right number of tokens
-    if len(tokens) != 1:
+    if len(tokens) > 3:
         print("Appointment search failed.")
         print("Incorrect number of inputs")
         print("Please try again!")
         return
 
     # Check if logged in
-    if ((current_caregiver == None) and (current_patient == None)):
+    if ((session.caregiver == None) and (session.patient == None)):
         print("Please login first!")
         return
 
-    # Get the appointments
-    cm = ConnectionManager()
-    conn = cm.create_connection()
-    cursor = conn.cursor()
-
-    upcomingAppointments = "SELECT * FROM Appointments WHERE Username = %s or PUsername = %s ORDER BY appointmentID"
     try:
-        if current_patient is None:
-            patient = 'null'
-            caregiver = current_caregiver.username
+        if len(tokens) == 2 and tokens[1] == "more":
+            if session.appointments_page is None:
+                print("No more appointments.")
+                return
+            start, end, after = session.appointments_page
+        elif len(tokens) == 2 and tokens[1] == "upcoming":
+            start, end, after = datetime.date.today(), None, None
         else:
-            patient = current_patient.username
-            caregiver = 'null'
-
-        cursor.execute(upcomingAppointments, (caregiver, patient))
+            start = Util.parse_date(tokens[1]) if len(tokens) > 1 else None
+            end = Util.parse_date(tokens[2]) if len(tokens) > 2 else None
+            after = None
+    except ValueError:
+        print("Please enter a valid date!")
+        print("Please try again!")
+        return
 
-        for row in cursor:
-            for i in row:
-                print(i,end=" ")
-            print()
+    if session.patient is None:
+        role, username = "caregiver", session.caregiver.username
+    else:
+        role, username = "patient", session.patient.username
 
-    except pymssql.Error:
+    # one row more than a page, to tell whether there is another page
+    page_size = int(os.getenv("AppointmentsPageSize", "50"))
+    limit = page_size + 1 if page_size > 0 else None
+    session.appointments_page = None
+    shown = 0
+    try:
+        # printed as the rows arrive, so the first ones show up right away
+        with closing(Appointment.iter_appointments(role, username, start, end, after, limit)) as appointments:
+            for appointment in appointments:
+                if page_size > 0 and shown == page_size:
+                    print("More appointments: show_appointments more")
+                    break
+                print(appointment.id, appointment.date, appointment.patient, appointment.caregiver, end=" ")
+                print()
+                shown += 1
+                session.appointments_page = (start, end, (appointment.date, appointment.id))
+            else:
+                session.appointments_page = None
+    except DBError:
         # print("Error occurred when getting Vaccine")
         print("Please try again!")
         raise
-    finally:
-        cm.close_connection()
     return None
 
 
+def cache_stats(tokens):
+    for cache in [Vaccine.catalog, Vaccine.stripe_counts, Caregiver.availability_cache]:
+        stats = cache.stats()
+        print("{name}: {size} entries, {hits} hits, {misses} misses, {evictions} evictions".format(name=cache.name, **stats))
+
+
+def metrics(tokens):
+    print(get_metrics().render(), end="")
+
+
+def query_stats(tokens):
+    # query_stats [<n>]: the statements that took the most time in total
+    try:
+        n = int(tokens[1]) if len(tokens) > 1 else 10
+    except ValueError:
+        print("Please try again!")
+        return
+    for statement, stats in get_tracer().top(n):
+        print("{total:.1f}ms total, {count} runs, {avg:.2f}ms avg, {max:.2f}ms max, {slow} slow: {statement}".format(
+            total=stats.total, count=stats.count, avg=stats.total / stats.count, max=stats.max, slow=stats.slow,
+            statement=get_tracer().normalize(statement)))
+
+
 def logout(tokens):
-    global current_patient
-    global current_caregiver
+    session = current_session()
     try:
-        if current_patient is None and current_caregiver is None:
+        if session.patient is None and session.caregiver is None:
             print("Please login first.")
             return
-        if current_patient is not None:
-            current_patient = None
-        if current_caregiver is not None:
-            current_caregiver = None
+        if session.token is not None:
+            get_session_store().revoke(session.token)
+            session.token = None
+        if session.patient is not None:
+            session.patient = None
+        if session.caregiver is not None:
+            session.caregiver = None
+        session.appointments_page = None
         print("Successfully logged out!")
     except Exception as e:
         print("Please try again!")
         return
 
 
-def start():
-    stop = False
+COMMANDS = {"create_patient", "create_caregiver", "provision_users", "login_patient", "login_caregiver", "resume",
+            "search_caregiver_schedule", "first_available", "reserve", "reserve_batch", "upload_availability",
+            "cancel", "cancel_caregiver", "add_doses", "import_doses", "stripe_vaccine", "show_appointments",
+            "cache_stats", "metrics", "query_stats", "logout", "quit"}
+
+
+def print_commands():
     print()
     print(" *** Please enter one of the following commands *** ")
     print("> create_patient <username> <password>") 
     print("> create_caregiver <username> <password>")
+    print("> provision_users <file.csv> [<batch_size>]")
     print("> login_patient <username> <password>")  
     print("> login_caregiver <username> <password>")
+    print("> resume <session_token>")
     print("> search_caregiver_schedule <date>") 
-    print("> reserve <date> <vaccine>")
-    print("> upload_availability <date>")
-    print("> cancel <appointment_id>")  # // TODO: implement cancel (extra credit)
+    print("> search_caregiver_schedule <start_date> <end_date> | next <days>")
+    print("> first_available <vaccine> [<start_date>]")
+    print("> reserve <date> <vaccine> [<caregiver>]")
+    print("> reserve_batch <file.csv> [<batch_size>]")
+    print("> upload_availability <date> [<end_date> [daily | weekdays | weekends | mon,wed,fri]]")
+    print("> cancel <appointment_id>")
+    print("> cancel_caregiver <caregiver> <start_date> [<end_date>]")
     print("> add_doses <vaccine> <number>")
-    print("> show_appointments")  # // TODO: implement show_appointments (Part 2)
+    print("> import_doses <file.csv> [<batch_size>]")
+    print("> stripe_vaccine <vaccine> <stripes>")
+    print("> show_appointments [upcoming | <start_date> [<end_date>] | more]")
+    print("> cache_stats")
+    print("> metrics")
+    print("> query_stats [<n>]")
     print("> logout") 
     print("> Quit")
     print()
+
+
+# the token of each command that is a file path, which keeps its case
+FILE_ARGUMENTS = {"provision_users": 1, "import_doses": 1, "reserve_batch": 1}
+
+
+def run_command(response):
+    # run one command line; returns False once the user quits
+    tokens = response.split(" ")
+    file_argument = FILE_ARGUMENTS.get(tokens[0].lower())
+    tokens = [token if i == file_argument else token.lower() for i, token in enumerate(tokens)]
+    if len(tokens) == 0:
+        ValueError("Please try again!")
+        return True
+    operation = tokens[0]
+    # unknown operations share one label so typos cannot grow the metrics
+    with get_metrics().command(operation if operation in COMMANDS else "invalid"):
+        return dispatch(operation, tokens)
+
+
+def dispatch(operation, tokens):
+    if operation == "create_patient":
+        create_patient(tokens)
+    elif operation == "create_caregiver":
+        create_caregiver(tokens)
+    elif operation == "provision_users":
+        provision_users(tokens)
+    elif operation == "login_patient":
+        login_patient(tokens)
+    elif operation == "login_caregiver":
+        login_caregiver(tokens)
+    elif operation == "resume":
+        resume(tokens)
+    elif operation == "search_caregiver_schedule":
+        search_caregiver_schedule(tokens)
+    elif operation == "first_available":
+        first_available(tokens)
+    elif operation == "reserve":
+        reserve(tokens)
+    elif operation == "reserve_batch":
+        reserve_batch(tokens)
+    elif operation == "upload_availability":
+        upload_availability(tokens)
+    elif operation == "cancel":
+        cancel(tokens)
+    elif operation == "cancel_caregiver":
+        cancel_caregiver(tokens)
+    elif operation == "add_doses":
+        add_doses(tokens)
+    elif operation == "import_doses":
+        import_doses(tokens)
+    elif operation == "stripe_vaccine":
+        stripe_vaccine(tokens)
+    elif operation == "show_appointments":
+        show_appointments(tokens)
+    elif operation == "cache_stats":
+        cache_stats(tokens)
+    elif operation == "metrics":
+        metrics(tokens)
+    elif operation == "query_stats":
+        query_stats(tokens)
+    elif operation == "logout":
+        logout(tokens)
+    elif operation == "quit":
+        print("Bye!")
+        return False
+    else:
+        print("Invalid operation name!")
+    return True
+
+
+def start():
+    stop = False
+    print_commands()
     while not stop:
         response = ""
         print("> ", end='')
 
         try:
             response = str(input())
+        except EOFError:
+            break
         except ValueError:
             print("Please try again!")
             break
 
-        response = response.lower()
-        tokens = response.split(" ")
-        if len(tokens) == 0:
-            ValueError("Please try again!")
-            continue
-        operation = tokens[0]
-        if operation == "create_patient":
-            create_patient(tokens)
-        elif operation == "create_caregiver":
-            create_caregiver(tokens)
-        elif operation == "login_patient":
-            login_patient(tokens)
-        elif operation == "login_caregiver":
-            login_caregiver(tokens)
-        elif operation == "search_caregiver_schedule":
-            search_caregiver_schedule(tokens)
-        elif operation == "reserve":
-            reserve(tokens)
-        elif operation == "upload_availability":
-            upload_availability(tokens)
-        elif operation == "cancel":
-            cancel(tokens)
-        elif operation == "add_doses":
-            add_doses(tokens)
-        elif operation == "show_appointments":
-            show_appointments(tokens)
-        elif operation == "logout":
-            logout(tokens)
-        elif operation == "quit":
-            print("Bye!")
-            stop = True
+        stop = not run_command(response)
+
+
+def clear_caches():
+    Vaccine.catalog.clear()
+    Vaccine.stripe_counts.clear()
+    Caregiver.availability_cache.clear()
+
+
+def run_batch(lines, group=0, quiet=False):
+    # run command lines without prompts or banners and return a summary.
+    # "begin", "commit" and "rollback" lines group the commands between them
+    # into one transaction; group=N does the same for every N commands.
+    session = current_session()
+    if quiet:
+        # discarded as it is written, so long batches do not pile it up
+        install_session_stdout()
+        session.out = open(os.devnull, "w")
+    latencies = {}
+    transaction = None
+    grouped = 0
+    commands = 0
+    start_time = time.perf_counter()
+
+    def begin():
+        nonlocal transaction, grouped
+        transaction = ConnectionManager.transaction()
+        transaction.__enter__()
+        grouped = 0
+
+    def end(commit):
+        nonlocal transaction
+        if transaction is None:
+            return
+        current, transaction = transaction, None
+        if commit:
+            current.__exit__(None, None, None)
         else:
-            print("Invalid operation name!")
+            try:
+                current.__exit__(RuntimeError, RuntimeError("rolled back"), None)
+            finally:
+                clear_caches()
+
+    try:
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            operation = line.split(" ")[0].lower()
+            if operation == "begin":
+                end(True)
+                begin()
+                continue
+            if operation in ("commit", "rollback"):
+                end(operation == "commit")
+                continue
+            if group and transaction is None:
+                begin()
+
+            command_start = time.perf_counter()
+            keep_going = run_command(line)
+            latencies.setdefault(operation, []).append(time.perf_counter() - command_start)
+            commands += 1
+            grouped += 1
+
+            if not keep_going:
+                break
+            if group and grouped >= group:
+                end(True)
+        end(True)
+    except BaseException:
+        # a command quit() on a database error: drop the open group
+        end(False)
+        raise
+    finally:
+        if quiet:
+            session.out.close()
+            session.out = None
+        elapsed = time.perf_counter() - start_time
+        print_batch_summary(commands, elapsed, latencies)
+
+
+def print_batch_summary(commands, elapsed, latencies):
+    print("{commands} commands in {elapsed:.3f}s ({rate:.1f} commands/s)".format(
+        commands=commands, elapsed=elapsed, rate=commands / elapsed if elapsed > 0 else 0))
+    print("{:<28} {:>8} {:>10} {:>10} {:>10}".format("command", "count", "p50 ms", "p95 ms", "max ms"))
+    for operation, values in sorted(latencies.items()):
+        values.sort()
+        print("{:<28} {:>8} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+            operation, len(values), Util.percentile(values, 50) * 1000,
+            Util.percentile(values, 95) * 1000, values[-1] * 1000))
 
 
 if __name__ == "__main__":
@@ -657,9 +1114,27 @@ if __name__ == "__main__":
     // for the simplicity of this assignment
     // and then construct a map of vaccineName -> vaccineObject
     '''
+    parser = argparse.ArgumentParser(description="COVID-19 Vaccine Reservation Scheduling Application")
+    parser.add_argument("--batch", metavar="FILE", help="run the commands in FILE ('-' for stdin) instead of prompting")
+    parser.add_argument("--group", type=int, default=0, metavar="N", help="with --batch, commit every N commands as one transaction")
+    parser.add_argument("--quiet", action="store_true", help="with --batch, only print the summary")
+    args = parser.parse_args()
+
+    if args.batch:
+        migrate(verbose=False)
+        if args.batch == "-":
+            run_batch(sys.stdin, args.group, args.quiet)
+        else:
+            with open(args.batch) as f:
+                run_batch(f, args.group, args.quiet)
+        ConnectionManager.close_pool()
+        sys.exit(0)
 
     # start command line
     print()
     print("Welcome to the COVID-19 Vaccine Reservation Scheduling Application!")
 
+    # bring the database schema up to date before taking commands
+    migrate()
     start()
+    ConnectionManager.close_pool()
@@ -0,0 +1,110 @@
+import argparse
+import io
+import os
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+import Scheduler
+from db.ConnectionManager import ConnectionManager
+from db.Migrations import migrate
+from util.Session import Session, use_session, reset_session, install_session_stdout
+from util.Metrics import serve_metrics
+
+
+'''
+Serves the Scheduler commands to many clients at once over TCP.
+
+The protocol is line based: a client sends one command per line, exactly as
+it would type it at the command line, and gets back the command's output
+followed by a line holding a single ".". Each connection has its own Session,
+so clients log in and out independently. Commands from all connections run on
+a shared, bounded pool of worker threads on top of the shared connection pool.
+
+    python Server.py --port 8765 --workers 16
+    nc localhost 8765
+'''
+
+END_OF_RESPONSE = "."
+
+
+def run_command(session, line):
+    # run one command line as session; returns (output, keep_connection)
+    token = use_session(session)
+    session.out = io.StringIO()
+    try:
+        keep_going = Scheduler.run_command(line)
+    except SystemExit:
+        # commands quit() on database errors; only this client goes away
+        keep_going = False
+    except Exception as e:
+        print("Error:", e)
+        print("Please try again!")
+        keep_going = True
+    finally:
+        output = session.out.getvalue()
+        session.out = None
+        reset_session(token)
+    return output, keep_going
+
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    def respond(self, output):
+        if output and not output.endswith("\n"):
+            output += "\n"
+        self.wfile.write((output + END_OF_RESPONSE + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def handle(self):
+        session = Session()
+        for raw in self.rfile:
+            line = raw.decode("utf-8", errors="replace").rstrip("\r\n")
+            if not line.strip():
+                continue
+            output, keep_going = self.server.workers.submit(run_command, session, line).result()
+            self.respond(output)
+            if not keep_going:
+                break
+
+
+class SchedulerServer(socketserver.ThreadingTCPServer):
+    # a thread per connection only waits on its socket; commands run on the workers
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, workers):
+        super().__init__(address, CommandHandler)
+        self.workers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="command")
+
+    def server_close(self):
+        super().server_close()
+        self.workers.shutdown(wait=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve Scheduler commands over TCP")
+    parser.add_argument("--host", default=os.getenv("ServerHost", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("ServerPort", "8765")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("ServerWorkers", os.getenv("PoolMaxSize", "10"))))
+    parser.add_argument("--metrics-port", type=int, default=int(os.getenv("MetricsPort", "0")),
+                        help="serve Prometheus metrics on http://<host>:<port>/metrics; 0 to disable")
+    parser.add_argument("--import-dir", default=os.getenv("ImportDir", ""),
+                        help="directory the file commands may read from; empty to refuse them")
+    args = parser.parse_args()
+    Scheduler.import_dir = args.import_dir
+
+    migrate()
+    install_session_stdout()
+    server = SchedulerServer((args.host, args.port), args.workers)
+    if args.metrics_port:
+        serve_metrics(args.host, args.metrics_port)
+    print("Serving on {host}:{port} with {workers} workers".format(host=args.host, port=args.port, workers=args.workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        ConnectionManager.close_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import argparse
+import os
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from util.PasswordHasher import PasswordHasher
+
+
+'''
+Password hashing throughput at different PBKDF2 costs.
+
+For each iteration count it hashes a burst of passwords on a PasswordHasher
+pool and reports logins/second overall and per core, which is the upper bound
+on how many logins a server with that many cores can verify.
+
+    python bench/HashBenchmark.py --iterations 50000 100000 200000 --logins 64
+'''
+
+
+def run(iterations, logins, workers):
+    hasher = PasswordHasher(iterations=iterations, workers=workers)
+    salt = os.urandom(16)
+    try:
+        # warm up the worker threads
+        hasher.map([("warmup", salt)] * workers)
+        start = time.perf_counter()
+        hasher.map([("password%d" % i, salt) for i in range(logins)])
+        elapsed = time.perf_counter() - start
+    finally:
+        hasher.shutdown()
+    rate = logins / elapsed
+    return rate, rate / workers, elapsed / logins * workers * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark password hashing cost settings")
+    parser.add_argument("--iterations", type=int, nargs="+", default=[10000, 50000, 100000, 200000, 600000])
+    parser.add_argument("--logins", type=int, default=64, help="hashes per cost setting")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    print("{:>12} {:>14} {:>16} {:>14}".format("iterations", "logins/s", "logins/s/core", "ms/login"))
+    for iterations in args.iterations:
+        rate, per_core, latency = run(iterations, args.logins, args.workers)
+        print("{:>12} {:>14.1f} {:>16.1f} {:>14.2f}".format(iterations, rate, per_core, latency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+import argparse
+import datetime
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+'''
+Load generator and latency benchmark for the Scheduler commands.
+
+Seeds caregivers, patients, vaccine stock and availability, then has many
+concurrent clients run a mixed workload of command lines, each client with
+its own Session, through the same code path as a Server connection. Reports
+throughput, p50/p95/p99 latency and database round trips per command, and
+checks the database afterwards for double bookings, duplicate appointment IDs
+and negative stock.
+
+By default it runs against a fresh SQLite file; --backend env uses whatever
+DBBackend and friends are set to instead (careful: it writes test data).
+
+    python bench/LoadBenchmark.py --caregivers 50 --patients 500 --days 30 \\
+        --clients 16 --commands 200 --seed 1
+'''
+
+DEFAULT_MIX = "search=40,reserve=20,show=15,login=10,cancel=5,create=5,range=5"
+
+APPOINTMENT_ID = re.compile(r"Appointment ID: (\d+)")
+
+
+class RoundTripCounter:
+    '''
+    Wraps the backend's connections to count statements per thread, so the
+    client thread that ran a command can read off how many it cost.
+    '''
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def count(self):
+        return getattr(self.local, "count", 0)
+
+    def hit(self):
+        self.local.count = self.count() + 1
+
+    def wrap(self, connect):
+        counter = self
+
+        class Cursor:
+            def __init__(self, cursor):
+                self.cursor = cursor
+
+            def execute(self, *args, **kwargs):
+                counter.hit()
+                return self.cursor.execute(*args, **kwargs)
+
+            def executemany(self, *args, **kwargs):
+                counter.hit()
+                return self.cursor.executemany(*args, **kwargs)
+
+            def __iter__(self):
+                return iter(self.cursor)
+
+            def __getattr__(self, name):
+                return getattr(self.cursor, name)
+
+        class Connection:
+            def __init__(self, conn):
+                self.conn = conn
+
+            def cursor(self, *args, **kwargs):
+                return Cursor(self.conn.cursor(*args, **kwargs))
+
+            def commit(self):
+                counter.hit()
+                return self.conn.commit()
+
+            def __getattr__(self, name):
+                return getattr(self.conn, name)
+
+        return lambda: Connection(connect())
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, weight = part.split("=")
+        mix[name.strip()] = int(weight)
+    return mix
+
+
+def seed(args, start_date):
+    from model.Caregiver import Caregiver
+    from model.Patient import Patient
+    from model.Vaccine import Vaccine
+    from util.PasswordHasher import get_hasher
+    from util.Util import Util
+
+    hasher = get_hasher()
+    salt = Util.generate_salt()
+    hash = hasher.hash("pw", salt)
+    caregivers = [Caregiver("c%d" % i, salt=salt, hash=hash, hash_params=hasher.params) for i in range(args.caregivers)]
+    Caregiver.save_all(caregivers)
+    Patient.save_all([Patient("p%d" % i, salt=salt, hash=hash, hash_params=hasher.params) for i in range(args.patients)])
+    dates = Util.date_range(start_date, start_date + datetime.timedelta(days=args.days - 1))
+    for caregiver in caregivers:
+        caregiver.upload_availabilities(dates)
+    Vaccine.add_doses([(name, args.doses) for name in args.vaccines])
+    if args.stripes > 1:
+        for name in args.vaccines:
+            Vaccine.set_stripes(name, args.stripes)
+
+
+class Client(threading.Thread):
+    def __init__(self, number, args, mix, start_date, counter, results):
+        super().__init__(name="client-%d" % number)
+        self.number = number
+        self.args = args
+        self.mix = mix
+        self.start_date = start_date
+        self.counter = counter
+        self.results = results
+        self.random = random.Random(args.seed * 1000 + number)
+        self.appointments = []
+        self.created = 0
+
+    def date(self):
+        return (self.start_date + datetime.timedelta(days=self.random.randrange(self.args.days))).strftime("%m-%d-%Y")
+
+    def command(self, operation):
+        if operation == "search":
+            return "search_caregiver_schedule " + self.date()
+        if operation == "range":
+            return "search_caregiver_schedule {start} {end}".format(
+                start=self.start_date.strftime("%m-%d-%Y"),
+                end=(self.start_date + datetime.timedelta(days=min(self.args.days, 7) - 1)).strftime("%m-%d-%Y"))
+        if operation == "reserve":
+            return "reserve {date} {vaccine}".format(date=self.date(), vaccine=self.random.choice(self.args.vaccines))
+        if operation == "show":
+            return "show_appointments"
+        if operation == "cancel":
+            if not self.appointments:
+                return None
+            return "cancel " + self.appointments.pop(self.random.randrange(len(self.appointments)))
+        return None
+
+    def run_line(self, session, operation, line):
+        import Server
+        before = self.counter.count()
+        start = time.perf_counter()
+        output, keep_going = Server.run_command(session, line)
+        elapsed = time.perf_counter() - start
+        self.results.append((operation, elapsed, self.counter.count() - before, output))
+        return output
+
+    def run(self):
+        from util.Session import Session
+        session = Session()
+        patient = "p%d" % (self.number % self.args.patients)
+        self.run_line(session, "login", "login_patient {patient} pw".format(patient=patient))
+
+        operations = list(self.mix)
+        weights = [self.mix[o] for o in operations]
+        for _ in range(self.args.commands):
+            operation = self.random.choices(operations, weights)[0]
+            if operation == "login":
+                self.run_line(session, "logout", "logout")
+                self.run_line(session, "login", "login_patient {patient} pw".format(patient=patient))
+            elif operation == "create":
+                # new accounts log in on a session of their own
+                self.created += 1
+                username = "n{client}x{n}".format(client=self.number, n=self.created)
+                role = self.random.choice(["patient", "caregiver"])
+                self.run_line(Session(), "create", "create_{role} {username} pw".format(role=role, username=username))
+            else:
+                line = self.command(operation)
+                if line is None:
+                    continue
+                output = self.run_line(session, operation, line)
+                if operation == "reserve":
+                    match = APPOINTMENT_ID.search(output)
+                    if match:
+                        self.appointments.append(match.group(1))
+
+
+def check_consistency(reserved_ids):
+    from db.ConnectionManager import ConnectionManager
+    with ConnectionManager() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM (SELECT Time, Username FROM Appointments GROUP BY Time, Username HAVING COUNT(*) > 1) D")
+        double_bookings = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM Vaccines WHERE Doses < 0")
+        negative_stock = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM VaccineStripes WHERE Doses < 0")
+        negative_stock += cursor.fetchone()[0]
+        cursor.execute("SELECT C.Username, COUNT(A.appointmentID) FROM Caregivers C LEFT JOIN Appointments A ON A.Username = C.Username "
+                       "WHERE C.Username IN (SELECT Username FROM Availabilities) GROUP BY C.Username")
+        loads = [row[1] for row in cursor.fetchall()]
+    id_collisions = len(reserved_ids) - len(set(reserved_ids))
+    return double_bookings, id_collisions, negative_stock, loads
+
+
+def report(results, elapsed, clients, consistency):
+    from util.Util import Util
+    by_operation = {}
+    for operation, latency, round_trips, output in results:
+        by_operation.setdefault(operation, []).append((latency, round_trips))
+
+    print("{count} commands from {clients} clients in {elapsed:.3f}s ({rate:.1f} commands/s)".format(
+        count=len(results), clients=clients, elapsed=elapsed, rate=len(results) / elapsed if elapsed > 0 else 0))
+    print("{:<10} {:>8} {:>10} {:>10} {:>10} {:>12}".format("command", "count", "p50 ms", "p95 ms", "p99 ms", "round trips"))
+    for operation, values in sorted(by_operation.items()):
+        latencies = sorted(v[0] for v in values)
+        round_trips = sum(v[1] for v in values) / len(values)
+        print("{:<10} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>12.2f}".format(
+            operation, len(values), Util.percentile(latencies, 50) * 1000, Util.percentile(latencies, 95) * 1000,
+            Util.percentile(latencies, 99) * 1000, round_trips))
+    double_bookings, id_collisions, negative_stock, loads = consistency
+    if loads:
+        mean = sum(loads) / len(loads)
+        spread = (sum((load - mean) ** 2 for load in loads) / len(loads)) ** 0.5
+        print("appointments per caregiver: min {0}, max {1}, mean {2:.1f}, stdev {3:.1f}".format(
+            min(loads), max(loads), mean, spread))
+    print("double bookings: {0}, appointment ID collisions: {1}, vaccines with negative stock: {2}".format(
+        double_bookings, id_collisions, negative_stock))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the Scheduler commands")
+    parser.add_argument("--caregivers", type=int, default=20)
+    parser.add_argument("--patients", type=int, default=200)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--vaccines", nargs="+", default=["pfizer", "moderna", "janssen"])
+    parser.add_argument("--doses", type=int, default=100000)
+    parser.add_argument("--stripes", type=int, default=1, help="spread each vaccine's doses over this many rows")
+    parser.add_argument("--policy", choices=["least_loaded", "round_robin", "random", "first"],
+                        help="caregiver assignment policy (AssignmentPolicy)")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--commands", type=int, default=200, help="commands per client")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weights per command, e.g. " + DEFAULT_MIX)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--hash-iterations", type=int, default=1000,
+                        help="PBKDF2 cost; low by default so the database dominates")
+    parser.add_argument("--backend", choices=["sqlite", "env"], default="sqlite",
+                        help="a fresh SQLite file, or the backend configured in the environment")
+    args = parser.parse_args()
+
+    os.environ["HashIterations"] = str(args.hash_iterations)
+    if args.policy:
+        os.environ["AssignmentPolicy"] = args.policy
+    if args.backend == "sqlite":
+        os.environ["DBBackend"] = "sqlite"
+        os.environ["SQLitePath"] = os.path.join(tempfile.mkdtemp(prefix="scheduler-bench-"), "bench.db")
+    os.environ.setdefault("PoolMaxSize", str(args.clients))
+
+    from db.ConnectionManager import ConnectionManager
+    from db.Migrations import migrate
+    from util.Session import install_session_stdout
+
+    counter = RoundTripCounter()
+    backend = ConnectionManager.get_backend()
+    backend.connect = counter.wrap(backend.connect)
+    migrate(verbose=False)
+    install_session_stdout()
+
+    start_date = datetime.datetime(2030, 1, 1)
+    seed(args, start_date)
+
+    results = []
+    clients = [Client(i, args, parse_mix(args.mix), start_date, counter, results) for i in range(args.clients)]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+
+    reserved_ids = [APPOINTMENT_ID.search(r[3]).group(1) for r in results if r[0] == "reserve" and APPOINTMENT_ID.search(r[3])]
+    report(results, elapsed, args.clients, check_consistency(reserved_ids))
+    ConnectionManager.close_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+import datetime
+import os
+import re
+import sqlite3
+
+try:
+    import pymssql
+except ImportError:
+    pymssql = None
+
+
+'''
+Storage backends. The models write their SQL once, in pymssql's paramstyle
+(%s / %d placeholders) and with T-SQL in mind; every difference between that
+and the engine actually in use is dealt with here.
+
+The backend is picked with the DBBackend environment variable:
+    mssql   (default) Azure SQL Server, configured by Server/DBName/UserID/Password
+    sqlite  an embedded database file at SQLitePath (default: scheduler.db),
+            created from resources/create.sql on first use
+'''
+
+# catch these instead of a driver-specific error class
+DBError = (sqlite3.Error,) + ((pymssql.Error,) if pymssql is not None else ())
+# a constraint such as a primary key was violated
+DBIntegrityError = (sqlite3.IntegrityError,) + ((pymssql.IntegrityError,) if pymssql is not None else ())
+
+CREATE_SQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "resources", "create.sql")
+
+
+class Backend:
+    name = None
+
+    def connect(self):
+        raise NotImplementedError
+
+    def initialize(self):
+        # called once before the first connection is handed out
+        pass
+
+    def limit(self, query, n):
+        # keep only the first n rows of a SELECT (or INSERT ... SELECT)
+        return f"{query} LIMIT {int(n)}"
+
+    def lock_for_update(self, table, alias):
+        # an aliased table reference whose rows stay locked until the
+        # transaction ends
+        return f"{table} {alias}"
+
+    def lock_schema(self):
+        # a statement that, run first in a transaction, keeps every other
+        # process from migrating until the transaction ends. A write, even of
+        # no rows, takes SQLite's write lock; other writers wait for it.
+        return "UPDATE SchemaVersions SET Version = Version WHERE Version < 0"
+
+    # savepoint statements; None where the backend has no such statement
+    def savepoint(self, name):
+        return "SAVEPOINT " + name
+
+    def rollback_to_savepoint(self, name):
+        return "ROLLBACK TO SAVEPOINT " + name
+
+    def release_savepoint(self, name):
+        return "RELEASE SAVEPOINT " + name
+
+
+class MSSQLBackend(Backend):
+    name = "mssql"
+
+    def __init__(self):
+        if pymssql is None:
+            raise RuntimeError("pymssql is not installed; install it or set DBBackend=sqlite")
+        self.server_name = os.getenv("Server") + ".database.windows.net"
+        self.db_name = os.getenv("DBName")
+        self.user = os.getenv("UserID")
+        self.password = os.getenv("Password")
+
+    def limit(self, query, n):
+        return query.replace("SELECT ", f"SELECT TOP {int(n)} ", 1)
+
+    def lock_for_update(self, table, alias):
+        # T-SQL puts table hints after the alias
+        return f"{table} {alias} WITH (UPDLOCK, HOLDLOCK)"
+
+    def lock_schema(self):
+        return ("EXEC sp_getapplock @Resource = 'SchemaVersions', @LockMode = 'Exclusive', "
+                "@LockOwner = 'Transaction', @LockTimeout = 60000")
+
+    def savepoint(self, name):
+        return "SAVE TRANSACTION " + name
+
+    def rollback_to_savepoint(self, name):
+        return "ROLLBACK TRANSACTION " + name
+
+    def release_savepoint(self, name):
+        return None
+
+    def connect(self):
+        return pymssql.connect(server=self.server_name, user=self.user, password=self.password, database=self.db_name)
+
+
+# SQLite has no date type: store dates as ISO text and read columns declared
+# as "date" back as datetime.date, the way pymssql returns them
+sqlite3.register_adapter(datetime.date, lambda d: d.isoformat())
+sqlite3.register_adapter(datetime.datetime, lambda d: d.date().isoformat())
+sqlite3.register_converter("date", lambda b: datetime.date.fromisoformat(b.decode()))
+
+_PLACEHOLDER = re.compile(r"%[sd]")
+_translations = {}
+
+
+def _to_qmark(query):
+    translated = _translations.get(query)
+    if translated is None:
+        translated = _PLACEHOLDER.sub("?", query).replace("%%", "%")
+        _translations[query] = translated
+    return translated
+
+
+def _params(params):
+    # pymssql accepts a bare value for a single placeholder
+    if params is None:
+        return ()
+    if isinstance(params, (tuple, list, dict)):
+        return params
+    return (params,)
+
+
+def _dict_row(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+class SQLiteCursor:
+    def __init__(self, conn, as_dict=False):
+        self.conn = conn
+        self.cursor = conn.raw.cursor()
+        if as_dict:
+            self.cursor.row_factory = _dict_row
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def execute(self, query, params=None):
+        self.conn.begin()
+        self.cursor.execute(_to_qmark(query), _params(params))
+        return self
+
+    def executemany(self, query, seq_of_params):
+        self.conn.begin()
+        self.cursor.executemany(_to_qmark(query), [_params(p) for p in seq_of_params])
+        return self
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        return self.cursor.fetchmany(size if size is not None else self.cursor.arraysize)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def close(self):
+        self.cursor.close()
+
+
+class SQLiteConnection:
+    '''
+    Gives a sqlite3 connection pymssql's interface: cursor(as_dict=True), the
+    %s paramstyle, and a transaction that is opened implicitly by the first
+    statement and stays open until commit() or rollback().
+    '''
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def begin(self):
+        if not self.raw.in_transaction:
+            self.raw.execute("BEGIN")
+
+    def cursor(self, as_dict=False):
+        return SQLiteCursor(self, as_dict)
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        self.raw.close()
+
+
+class SQLiteBackend(Backend):
+    name = "sqlite"
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv("SQLitePath", "scheduler.db")
+        self.busy_timeout = float(os.getenv("SQLiteBusyTimeout", "30"))
+
+    def connect(self):
+        # the pool moves connections between threads, one borrower at a time
+        raw = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                              detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        raw.execute("PRAGMA foreign_keys = OFF")
+        raw.execute("PRAGMA synchronous = NORMAL")
+        return SQLiteConnection(raw)
+
+    def initialize(self):
+        raw = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+        try:
+            raw.execute("PRAGMA journal_mode = WAL")
+            # under the write lock and in one transaction, so processes
+            # starting together create the schema once and never see half of it
+            raw.execute("BEGIN IMMEDIATE")
+            exists = raw.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Caregivers'").fetchone()
+            if exists is None:
+                with open(CREATE_SQL) as f:
+                    for statement in f.read().split(";"):
+                        if statement.strip():
+                            raw.execute(statement)
+            raw.execute("COMMIT")
+        finally:
+            raw.close()
+
+
+BACKENDS = {
+    MSSQLBackend.name: MSSQLBackend,
+    SQLiteBackend.name: SQLiteBackend,
+}
+
+
+def get_backend():
+    name = os.getenv("DBBackend", MSSQLBackend.name).lower()
+    if name not in BACKENDS:
+        raise ValueError("Unknown DBBackend: " + name)
+    return BACKENDS[name]()
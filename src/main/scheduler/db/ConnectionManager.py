@@ -1,29 +1,329 @@
-import pymssql
+import contextvars
 import os
+import threading
+import time
+from contextlib import contextmanager
+from db.Backend import DBError, get_backend
+from db.Instrumented import instrument
+from util.Metrics import get_metrics
+
+
+class PooledConnection:
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+
+class ConnectionPool:
+    '''
+    A bounded, thread-safe pool of open database connections.
+
+    Connections are handed out by acquire() and handed back by release(). Idle
+    connections are kept around for reuse, so only the first command pays the
+    cost of connecting to the server. A connection is thrown away instead of
+    being reused when it
+      - has been idle for longer than idle_timeout seconds,
+      - is older than max_lifetime seconds, or
+      - fails the health check (a "SELECT 1"), which is only run when the
+        connection has been idle for longer than health_check_interval seconds.
+    At most max_size connections are open at once; acquire() blocks for up to
+    acquire_timeout seconds waiting for one to be released.
+    '''
+
+    def __init__(self, connect, max_size=10, idle_timeout=300, max_lifetime=1800,
+                 health_check_interval=30, acquire_timeout=30):
+        if max_size <= 0:
+            raise ValueError("Pool size must be positive!")
+        self.connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+
+        self._idle = []
+        self._in_use = {}
+        self._lock = threading.Condition()
+        self._closed = False
+
+    def size(self):
+        with self._lock:
+            return len(self._idle) + len(self._in_use)
+
+    def in_use(self):
+        with self._lock:
+            return len(self._in_use)
+
+    def _expired(self, pooled, now):
+        return (now - pooled.created_at > self.max_lifetime
+                or now - pooled.last_used > self.idle_timeout)
+
+    def _healthy(self, pooled, now):
+        if now - pooled.last_used <= self.health_check_interval:
+            return True
+        try:
+            cursor = pooled.conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, pooled):
+        try:
+            pooled.conn.close()
+        except Exception:
+            pass
+
+    def evict_idle(self):
+        # drop idle connections that are past their idle timeout or lifetime
+        now = time.monotonic()
+        with self._lock:
+            stale = [p for p in self._idle if self._expired(p, now)]
+            self._idle = [p for p in self._idle if p not in stale]
+            if stale:
+                self._lock.notify_all()
+        for pooled in stale:
+            self._discard(pooled)
+
+    def acquire(self):
+        self.evict_idle()
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            pooled = None
+            with self._lock:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed!")
+                while not self._idle and len(self._in_use) >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError("Timed out waiting for a database connection!")
+                    self._lock.wait(remaining)
+                if self._idle:
+                    # most recently used first, so the rest can age out; it
+                    # holds its slot while being checked below
+                    pooled = self._idle.pop()
+                    self._in_use[id(pooled.conn)] = pooled
+                else:
+                    # reserve a slot while connecting outside the lock
+                    placeholder = object()
+                    self._in_use[id(placeholder)] = placeholder
+
+            if pooled is None:
+                try:
+                    pooled = PooledConnection(self.connect())
+                except BaseException:
+                    with self._lock:
+                        del self._in_use[id(placeholder)]
+                        self._lock.notify()
+                    raise
+                with self._lock:
+                    del self._in_use[id(placeholder)]
+                    self._in_use[id(pooled.conn)] = pooled
+                return pooled.conn
+
+            now = time.monotonic()
+            if self._expired(pooled, now) or not self._healthy(pooled, now):
+                with self._lock:
+                    del self._in_use[id(pooled.conn)]
+                    self._lock.notify()
+                self._discard(pooled)
+                continue
+            return pooled.conn
+
+    def release(self, conn, discard=False):
+        with self._lock:
+            pooled = self._in_use.pop(id(conn), None)
+            self._lock.notify()
+        if pooled is None:
+            return
+        if not discard:
+            # never hand an open transaction to the next borrower
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+        if discard or self._closed:
+            self._discard(pooled)
+            return
+        pooled.last_used = time.monotonic()
+        with self._lock:
+            self._idle.append(pooled)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._lock.notify_all()
+        for pooled in idle:
+            self._discard(pooled)
+
+
+class Transaction:
+    def __init__(self, conn, backend):
+        self.conn = conn
+        self.backend = backend
+        self.savepoints = 0
+        self.on_rollback = []
+
+
+class SavepointConnection:
+    '''
+    What ConnectionManager hands out inside ConnectionManager.transaction():
+    the transaction's connection, with commit() and rollback() scoped to a
+    savepoint taken at checkout. A model's commit keeps its work but leaves
+    it to the enclosing transaction to make durable; its rollback only undoes
+    its own work.
+    '''
+
+    def __init__(self, transaction):
+        self.transaction = transaction
+        transaction.savepoints += 1
+        self.name = "sp" + str(transaction.savepoints)
+        self._execute(transaction.backend.savepoint(self.name))
+
+    def _execute(self, statement):
+        if statement:
+            self.transaction.conn.cursor().execute(statement)
+
+    def cursor(self, *args, **kwargs):
+        return self.transaction.conn.cursor(*args, **kwargs)
+
+    def commit(self):
+        self._execute(self.transaction.backend.release_savepoint(self.name))
+        self._execute(self.transaction.backend.savepoint(self.name))
+
+    def rollback(self):
+        self._execute(self.transaction.backend.rollback_to_savepoint(self.name))
+
+    def close(self):
+        # like returning a connection to the pool: drop what was not committed
+        self.rollback()
+        self._execute(self.transaction.backend.release_savepoint(self.name))
+
+
+_transaction = contextvars.ContextVar("transaction", default=None)
 
 
 class ConnectionManager:
+    '''
+    Checks connections out of the pool shared by every model and command.
+
+        with ConnectionManager() as conn:
+            cursor = conn.cursor()
+            ...
+
+    create_connection()/close_connection() do the same checkout and return
+    by hand; closing hands the connection back to the pool rather than
+    closing it.
+
+    Inside "with ConnectionManager.transaction():" every checkout in the same
+    context shares one connection and one transaction instead, which commits
+    when the block ends and rolls back if it raises.
+    '''
+
+    _pool = None
+    _backend = None
+    _pool_lock = threading.Lock()
 
     def __init__(self):
-        self.server_name = os.getenv("Server") + ".database.windows.net"
-        self.db_name = os.getenv("DBName")
-        self.user = os.getenv("UserID")
-        self.password = os.getenv("Password")
         self.conn = None
 
+    @classmethod
+    def get_backend(cls):
+        with cls._pool_lock:
+            if cls._backend is None:
+                cls._backend = get_backend()
+            return cls._backend
+
+    @classmethod
+    def get_pool(cls):
+        backend = cls.get_backend()
+        with cls._pool_lock:
+            if cls._pool is None:
+                backend.initialize()
+                cls._pool = ConnectionPool(
+                    instrument(backend.connect),
+                    max_size=int(os.getenv("PoolMaxSize", "10")),
+                    idle_timeout=float(os.getenv("PoolIdleTimeout", "300")),
+                    max_lifetime=float(os.getenv("PoolMaxLifetime", "1800")),
+                    health_check_interval=float(os.getenv("PoolHealthCheckInterval", "30")),
+                    acquire_timeout=float(os.getenv("PoolAcquireTimeout", "30")))
+                metrics = get_metrics()
+                metrics.gauge("scheduler_db_pool_connections", lambda: cls._pool.size() if cls._pool else 0,
+                              "Connections open in the pool.")
+                metrics.gauge("scheduler_db_pool_in_use", lambda: cls._pool.in_use() if cls._pool else 0,
+                              "Connections checked out of the pool.")
+            return cls._pool
+
+    @classmethod
+    def close_pool(cls):
+        with cls._pool_lock:
+            pool, cls._pool = cls._pool, None
+            cls._backend = None
+        if pool is not None:
+            pool.close()
+
+    @classmethod
+    @contextmanager
+    def transaction(cls):
+        if _transaction.get() is not None:
+            raise RuntimeError("Transactions do not nest")
+        pool = cls.get_pool()
+        conn = pool.acquire()
+        transaction = Transaction(conn, cls.get_backend())
+        token = _transaction.set(transaction)
+        try:
+            yield transaction
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            for callback in transaction.on_rollback:
+                callback()
+            raise
+        finally:
+            _transaction.reset(token)
+            pool.release(conn)
+
+    @staticmethod
+    def in_transaction():
+        return _transaction.get() is not None
+
+    @staticmethod
+    def on_rollback(callback):
+        # call back if the enclosing transaction() rolls back; no-op outside one
+        transaction = _transaction.get()
+        if transaction is not None:
+            transaction.on_rollback.append(callback)
+
     def create_connection(self):
+        if self.conn is not None:
+            return self.conn
+        transaction = _transaction.get()
+        if transaction is not None:
+            self.conn = SavepointConnection(transaction)
+            return self.conn
         try:
-            self.conn = pymssql.connect(server=self.server_name, user=self.user, password=self.password, database=self.db_name)
-        except pymssql.Error as db_err:
+            with get_metrics().timer("scheduler_db_pool_wait_seconds"):
+                self.conn = self.get_pool().acquire()
+        except DBError as db_err:
             print("Database Programming Error in SQL connection processing! ")
             print(db_err)
             quit()
         return self.conn
 
     def close_connection(self):
-        try:
-            self.conn.close()
-        except pymssql.Error as db_err:
-            print("Database Programming Error in SQL connection processing! ")
-            print(db_err)
-            quit()
+        # safe to call more than once; only the first call returns the connection
+        conn, self.conn = self.conn, None
+        if isinstance(conn, SavepointConnection):
+            conn.close()
+        elif conn is not None:
+            self.get_pool().release(conn)
+
+    def __enter__(self):
+        return self.create_connection()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_connection()
+        return False
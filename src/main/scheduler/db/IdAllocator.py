@@ -0,0 +1,65 @@
+import os
+import threading
+from db.ConnectionManager import ConnectionManager
+from db.Backend import DBError
+
+
+class IdAllocator:
+    '''
+    Hands out unique integer IDs for one row of the Sequences table.
+
+    IDs are reserved from the database a block at a time (one short
+    transaction that bumps Sequences.NextValue by block_size) and then handed
+    out from memory, so most calls to next_id() never touch the database.
+    Every process reserves its own blocks, so IDs never collide between
+    clients; IDs left in a block when a process exits are simply skipped.
+
+    seed_query gives the first ID to use when the sequence row does not
+    exist yet, e.g. one past the largest ID already in the table.
+    '''
+
+    def __init__(self, name, seed_query, block_size=None):
+        self.name = name
+        self.seed_query = seed_query
+        self.block_size = block_size or int(os.getenv("IdBlockSize", "50"))
+        self._next = 0
+        self._end = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            if self._next >= self._end:
+                self._next, self._end = self._reserve_block()
+            id = self._next
+            self._next += 1
+            return id
+
+    def _forget_block(self, end):
+        with self._lock:
+            if self._end == end:
+                self._next = self._end = 0
+
+    def _reserve_block(self):
+        bump = "UPDATE Sequences SET NextValue = NextValue + %d WHERE Name = %s"
+        get_next = "SELECT NextValue FROM Sequences WHERE Name = %s"
+        seed = "INSERT INTO Sequences (Name, NextValue) SELECT %s, (" + self.seed_query + ") + %d"
+
+        with ConnectionManager() as conn:
+            cursor = conn.cursor()
+            for attempt in range(2):
+                try:
+                    cursor.execute(bump, (self.block_size, self.name))
+                    if cursor.rowcount == 0:
+                        cursor.execute(seed, (self.name, self.block_size))
+                    cursor.execute(get_next, self.name)
+                    end = cursor.fetchone()[0]
+                    conn.commit()
+                    # inside a ConnectionManager.transaction() the block is only
+                    # ours once that commits
+                    ConnectionManager.on_rollback(lambda: self._forget_block(end))
+                    return end - self.block_size, end
+                except DBError:
+                    # another client seeded the row first; bump it instead
+                    conn.rollback()
+                    if attempt == 1:
+                        raise
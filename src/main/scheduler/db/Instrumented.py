@@ -0,0 +1,100 @@
+import time
+from db.QueryTrace import get_tracer
+from util.Metrics import get_metrics, current_command
+
+
+class InstrumentedCursor:
+    '''
+    Wraps a driver cursor to count the statements it executes and the rows
+    it fetches, attributed to the command running at the time, and to time
+    each statement for the query tracer.
+
+    The time is that of execute() alone; a driver that streams results
+    spends more of a large SELECT in the fetches.
+    '''
+
+    def __init__(self, cursor, metrics, tracer):
+        self.cursor = cursor
+        self.metrics = metrics
+        self.tracer = tracer
+
+    def _traced(self, run, query, params, many=False):
+        command = current_command()
+        self.metrics.inc("scheduler_db_queries_total", command=command)
+        start = time.perf_counter()
+        try:
+            return run()
+        finally:
+            seconds = time.perf_counter() - start
+            if self.tracer.record(query, params, seconds, getattr(self.cursor, "rowcount", -1), command, many):
+                self.metrics.inc("scheduler_db_slow_queries_total", command=command)
+
+    def execute(self, query, params=None):
+        if params is None:
+            return self._traced(lambda: self.cursor.execute(query), query, params)
+        return self._traced(lambda: self.cursor.execute(query, params), query, params)
+
+    def executemany(self, query, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        return self._traced(lambda: self.cursor.executemany(query, seq_of_params), query, seq_of_params, many=True)
+
+    def _fetched(self, count):
+        if count:
+            self.metrics.inc("scheduler_db_rows_fetched_total", count, command=current_command())
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        self._fetched(0 if row is None else 1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.cursor.fetchmany(*args)
+        self._fetched(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self._fetched(len(rows))
+        return rows
+
+    def __iter__(self):
+        count = 0
+        try:
+            for row in self.cursor:
+                count += 1
+                yield row
+        finally:
+            self._fetched(count)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class InstrumentedConnection:
+    def __init__(self, conn, metrics, tracer):
+        self.conn = conn
+        self.metrics = metrics
+        self.tracer = tracer
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self.conn.cursor(*args, **kwargs), self.metrics, self.tracer)
+
+    def commit(self):
+        self.metrics.inc("scheduler_db_commits_total", command=current_command())
+        return self.conn.commit()
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+def instrument(connect):
+    # wrap a backend's connect() so its connections report to the metrics
+    # and the query tracer
+    metrics = get_metrics()
+    tracer = get_tracer()
+
+    def instrumented_connect():
+        conn = connect()
+        metrics.inc("scheduler_db_connections_opened_total")
+        return InstrumentedConnection(conn, metrics, tracer)
+    return instrumented_connect
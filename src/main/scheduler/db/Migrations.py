@@ -0,0 +1,151 @@
+import datetime
+from db.ConnectionManager import ConnectionManager
+from db.Backend import DBError
+
+
+'''
+Versioned schema changes applied on top of resources/create.sql.
+
+Each migration is (version, name, statements). statements is either a list of
+SQL statements for every backend, or a dict of such lists keyed by backend
+name when the dialects differ. A migration runs in one transaction together
+with the row that records it in SchemaVersions, so it is applied exactly once.
+That transaction first takes the backend's schema lock and checks the version
+again, so processes starting at the same time apply each migration once
+between them. Never edit a migration that has shipped; add a new one.
+'''
+
+MIGRATIONS = [
+    (1, "appointment id sequence", {
+        "mssql": [
+            "IF OBJECT_ID('Sequences') IS NULL "
+            "CREATE TABLE Sequences (Name varchar(255), NextValue int, PRIMARY KEY (Name))",
+        ],
+        "sqlite": [
+            "CREATE TABLE IF NOT EXISTS Sequences (Name varchar(255), NextValue int, PRIMARY KEY (Name))",
+        ],
+    }),
+    # Availabilities(Time) is already served by its (Time, Username) primary key
+    (2, "appointment indexes", [
+        # a caregiver can only be booked once per day; also backs the availability anti-join
+        "CREATE UNIQUE INDEX UX_Appointments_Time_Username ON Appointments (Time, Username)",
+        "CREATE INDEX IX_Appointments_PUsername ON Appointments (PUsername)",
+    ]),
+    # PasswordHasher params of each hash; NULL for hashes made before this
+    (3, "password hash parameters", {
+        "mssql": [
+            "ALTER TABLE Caregivers ADD HashParams varchar(64)",
+            "ALTER TABLE Patients ADD HashParams varchar(64)",
+        ],
+        "sqlite": [
+            "ALTER TABLE Caregivers ADD COLUMN HashParams varchar(64)",
+            "ALTER TABLE Patients ADD COLUMN HashParams varchar(64)",
+        ],
+    }),
+    # login tokens issued by SessionStore; ExpiresAt is in seconds since the epoch
+    (4, "sessions", [
+        "CREATE TABLE Sessions (Token varchar(64), Role varchar(16), Username varchar(255), ExpiresAt bigint, PRIMARY KEY (Token))",
+        "CREATE INDEX IX_Sessions_ExpiresAt ON Sessions (ExpiresAt)",
+    ]),
+    # doses of striped vaccines, see Vaccine.set_stripes
+    (5, "vaccine stripes", [
+        "CREATE TABLE VaccineStripes (Name varchar(255), Stripe int, Doses int, PRIMARY KEY (Name, Stripe))",
+    ]),
+    # show_appointments reads one user's appointments by (Time, appointmentID);
+    # these answer it from the index alone. The patient one replaces
+    # IX_Appointments_PUsername, which is its prefix.
+    (6, "appointment listing indexes", {
+        "mssql": [
+            "CREATE INDEX IX_Appointments_PUsername_Time ON Appointments (PUsername, Time, appointmentID) INCLUDE (Username)",
+            "CREATE INDEX IX_Appointments_Username_Time ON Appointments (Username, Time, appointmentID) INCLUDE (PUsername)",
+            "DROP INDEX IX_Appointments_PUsername ON Appointments",
+        ],
+        "sqlite": [
+            "CREATE INDEX IX_Appointments_PUsername_Time ON Appointments (PUsername, Time, appointmentID, Username)",
+            "CREATE INDEX IX_Appointments_Username_Time ON Appointments (Username, Time, appointmentID, PUsername)",
+            "DROP INDEX IX_Appointments_PUsername",
+        ],
+    }),
+    # the vaccine each appointment took a dose of, so cancelling can give it
+    # back (NULL for older appointments); and the pairs of moved appointments
+    # and new caregivers that Appointment.cancel_caregiver works through
+    (7, "appointment vaccines and rebookings", {
+        "mssql": [
+            "ALTER TABLE Appointments ADD Vaccine varchar(255)",
+            "CREATE TABLE Rebookings (Batch varchar(32), appointmentID int, Username varchar(255), PRIMARY KEY (Batch, appointmentID))",
+        ],
+        "sqlite": [
+            "ALTER TABLE Appointments ADD COLUMN Vaccine varchar(255)",
+            "CREATE TABLE Rebookings (Batch varchar(32), appointmentID int, Username varchar(255), PRIMARY KEY (Batch, appointmentID))",
+        ],
+    }),
+    # Sessions.Token now holds the SHA-256 of a token; the plaintext tokens
+    # stored before could no longer be looked up, so their users log in again
+    (8, "hashed session tokens", [
+        "DELETE FROM Sessions",
+    ]),
+]
+
+
+def _statements(migration, backend):
+    statements = migration[2]
+    if isinstance(statements, dict):
+        return statements.get(backend.name, [])
+    return statements
+
+
+def applied_versions(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT Version FROM SchemaVersions")
+        versions = {row[0] for row in cursor}
+        conn.commit()
+    except DBError:
+        conn.rollback()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("CREATE TABLE SchemaVersions (Version int, Name varchar(255), AppliedAt varchar(32), PRIMARY KEY (Version))")
+            conn.commit()
+            versions = set()
+        except DBError:
+            # another process created it first
+            conn.rollback()
+            cursor = conn.cursor()
+            cursor.execute("SELECT Version FROM SchemaVersions")
+            versions = {row[0] for row in cursor}
+            conn.commit()
+    return versions
+
+
+def migrate(verbose=True):
+    # apply every migration that this database has not seen yet, in order;
+    # returns the versions that were applied
+    backend = ConnectionManager.get_backend()
+    applied = []
+    with ConnectionManager() as conn:
+        done = applied_versions(conn)
+        for migration in sorted(MIGRATIONS):
+            version, name = migration[0], migration[1]
+            if version in done:
+                continue
+            cursor = conn.cursor()
+            try:
+                cursor.execute(backend.lock_schema())
+                cursor.execute("SELECT 1 FROM SchemaVersions WHERE Version = %d", version)
+                if cursor.fetchone() is not None:
+                    # another process applied it since we looked
+                    conn.commit()
+                    continue
+                for statement in _statements(migration, backend):
+                    cursor.execute(statement)
+                cursor.execute("INSERT INTO SchemaVersions VALUES (%d, %s, %s)",
+                               (version, name, datetime.datetime.now().isoformat(" ", "seconds")))
+                conn.commit()
+            except DBError:
+                conn.rollback()
+                print("Schema migration", version, "(" + name + ") failed")
+                raise
+            applied.append(version)
+            if verbose:
+                print("Applied schema migration", version, "(" + name + ")")
+    return applied
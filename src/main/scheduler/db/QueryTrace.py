@@ -0,0 +1,116 @@
+import datetime
+import os
+import random
+import sys
+import threading
+
+
+class StatementStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.slow = 0
+
+
+class QueryTracer:
+    '''
+    Times every statement run through the pool's cursors (see
+    db/Instrumented.py) and keeps running totals per statement text, so
+    query_stats() can show which statements take the most time overall.
+
+    A statement is also written to the query log when it
+      - takes at least slow_ms milliseconds (the slow-query log; a negative
+        slow_ms turns it off), or
+      - is picked by sampling, each statement with probability sample_rate.
+    Log lines carry the duration, the command that ran the statement, the
+    row count and the parameters with strings and bytes redacted, since those
+    include passwords, salts and hashes. The log goes to log_path, or to
+    stderr when that is empty.
+
+    The totals cost a lock and a dictionary update per statement, and the
+    log is only written for slow or sampled statements, so tracing can stay
+    on in production.
+    '''
+
+    # statements beyond this many distinct texts are timed but not totalled
+    MAX_STATEMENTS = 500
+
+    def __init__(self, slow_ms=None, sample_rate=None, log_path=None):
+        self.slow_ms = slow_ms if slow_ms is not None else float(os.getenv("SlowQueryMs", "100"))
+        self.sample_rate = sample_rate if sample_rate is not None else float(os.getenv("QuerySampleRate", "0"))
+        self.log_path = log_path if log_path is not None else os.getenv("QueryLogPath", "")
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._log = None
+
+    @staticmethod
+    def redact(params):
+        if params is None:
+            return ()
+        if not isinstance(params, (tuple, list)):
+            params = (params,)
+        redacted = []
+        for value in params:
+            if isinstance(value, str):
+                redacted.append("<str:{0}>".format(len(value)))
+            elif isinstance(value, (bytes, bytearray)):
+                redacted.append("<bytes:{0}>".format(len(value)))
+            else:
+                redacted.append(value)
+        return tuple(redacted)
+
+    @staticmethod
+    def normalize(statement):
+        return " ".join(statement.split())
+
+    def record(self, statement, params, seconds, rowcount, command, many=False):
+        ms = seconds * 1000
+        slow = 0 <= self.slow_ms <= ms
+        sampled = not slow and self.sample_rate > 0 and random.random() < self.sample_rate
+        with self._lock:
+            stats = self._stats.get(statement)
+            if stats is None and len(self._stats) < self.MAX_STATEMENTS:
+                stats = self._stats[statement] = StatementStats()
+            if stats is not None:
+                stats.count += 1
+                stats.total += ms
+                stats.max = max(stats.max, ms)
+                stats.rows += max(rowcount, 0)
+                stats.slow += slow
+        if slow or sampled:
+            shown = "<{0} rows>".format(len(params)) if many else self.redact(params)
+            self.write("{time} {kind} {ms:.2f}ms command={command} rows={rows} {statement} params={params}".format(
+                time=datetime.datetime.now().isoformat(timespec="milliseconds"), kind="slow" if slow else "sample",
+                ms=ms, command=command, rows=rowcount, statement=self.normalize(statement), params=shown))
+        return slow
+
+    def write(self, line):
+        with self._lock:
+            if self._log is None:
+                self._log = open(self.log_path, "a", buffering=1) if self.log_path else sys.__stderr__
+            self._log.write(line + "\n")
+
+    def top(self, n=10):
+        # [(statement, stats)] for the n statements with the most total time
+        with self._lock:
+            items = [(statement, stats) for statement, stats in self._stats.items()]
+        items.sort(key=lambda item: item[1].total, reverse=True)
+        return items[:n]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_tracer():
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = QueryTracer()
+        return _default
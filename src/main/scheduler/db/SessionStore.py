@@ -0,0 +1,125 @@
+import hashlib
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from db.ConnectionManager import ConnectionManager
+
+
+class SessionStore:
+    '''
+    Opaque, expiring login tokens.
+
+    A token is issued once a password has been checked and stands in for it
+    afterwards, so later commands (or a later process) skip PBKDF2 entirely.
+    Tokens live in the Sessions table so any client can resume them, with an
+    in-process LRU of recently used tokens in front of it: a lookup is a dict
+    hit in the common case and one primary-key read otherwise.
+
+    Only the SHA-256 of a token is stored, in the table and in the cache, so
+    reading the Sessions table does not give anyone a usable token.
+
+    A cached session is read again from the table once it is recheck seconds
+    old (SessionRecheck), so a token revoked by another process stops working
+    here within that time rather than when it expires. Expired tokens are
+    dropped from the cache when they are looked up and from the table every
+    purge_every issued tokens.
+    '''
+
+    def __init__(self, ttl=None, cache_size=None, recheck=None, purge_every=100):
+        self.ttl = ttl or int(os.getenv("SessionTTL", str(8 * 60 * 60)))
+        self.cache_size = cache_size or int(os.getenv("SessionCacheSize", "10000"))
+        self.recheck = recheck if recheck is not None else float(os.getenv("SessionRecheck", "30"))
+        self.purge_every = purge_every
+        self._cache = OrderedDict()
+        self._issued = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def _remember(self, key, session):
+        with self._lock:
+            self._cache[key] = (time.monotonic() + self.recheck, session)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _forget(self, key):
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def issue(self, role, username):
+        # hex so the token survives the command line being lowercased
+        token = secrets.token_hex(32)
+        key = self._key(token)
+        expires_at = int(time.time()) + self.ttl
+        with ConnectionManager() as conn:
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO Sessions (Token, Role, Username, ExpiresAt) VALUES (%s, %s, %s, %d)",
+                           (key, role, username, expires_at))
+            conn.commit()
+        self._remember(key, (role, username, expires_at))
+
+        with self._lock:
+            self._issued += 1
+            purge = self._issued % self.purge_every == 0
+        if purge:
+            self.purge_expired()
+        return token
+
+    def lookup(self, token):
+        # (role, username) for a live token, else None
+        key = self._key(token)
+        now = int(time.time())
+        session = None
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                session = entry[1]
+                self._cache.move_to_end(key)
+        if session is None:
+            with ConnectionManager() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT Role, Username, ExpiresAt FROM Sessions WHERE Token = %s", key)
+                row = cursor.fetchone()
+            if row is None:
+                self._forget(key)
+                return None
+            session = tuple(row)
+            self._remember(key, session)
+        role, username, expires_at = session
+        if expires_at <= now:
+            self.revoke(token)
+            return None
+        return role, username
+
+    def revoke(self, token):
+        key = self._key(token)
+        self._forget(key)
+        with ConnectionManager() as conn:
+            conn.cursor().execute("DELETE FROM Sessions WHERE Token = %s", key)
+            conn.commit()
+
+    def purge_expired(self):
+        now = int(time.time())
+        with self._lock:
+            for key in [k for k, entry in self._cache.items() if entry[1][2] <= now]:
+                del self._cache[key]
+        with ConnectionManager() as conn:
+            conn.cursor().execute("DELETE FROM Sessions WHERE ExpiresAt <= %d", now)
+            conn.commit()
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_session_store():
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = SessionStore()
+        return _default
@@ -1,28 +1,341 @@
 import sys
+import uuid
 sys.path.append("../util/*")
 sys.path.append("../db/*")
 from util.Util import Util
 from db.ConnectionManager import ConnectionManager
-import pymssql
+from db.Backend import DBError
+from db.IdAllocator import IdAllocator
+from model.Vaccine import Vaccine
+from model.Caregiver import Caregiver
+from model.Assignment import AssignmentEngine
+from model.Repository import Repository
 
 
 class Appointment:
-    def __init__(self, id, patient, caregiver, date):
+    __slots__ = ("id", "patient", "caregiver", "date", "vaccine")
+
+    ids = IdAllocator("Appointments", "SELECT COALESCE(MAX(appointmentID) + 1, 0) FROM Appointments")
+    assignment = AssignmentEngine()
+
+    def __init__(self, id, patient, caregiver, date, vaccine=None):
         self.id = id
         self.patient = patient
         self.caregiver = caregiver
         self.date = date
+        # the vaccine the appointment took a dose of; None for old appointments
+        self.vaccine = vaccine
 
     def create(self):
         cm = ConnectionManager()
         conn = cm.create_connection()
         cursor = conn.cursor()
 
-        add_appointment = "INSERT INTO Appointments VALUES (%s, %s, %s, %s)"
+        add_appointment = "INSERT INTO Appointments (appointmentID, Time, PUsername, Username, Vaccine) VALUES (%s, %s, %s, %s, %s)"
         try:
-            cursor.execute(add_appointment, (self.id, self.date, self.patient, self.caregiver))
+            cursor.execute(add_appointment, (self.id, self.date, self.patient, self.caregiver, self.vaccine))
             conn.commit()
-        except pymssql.Error as e:
+        except DBError as e:
             raise e
         finally:
             cm.close_connection()
+
+    # every appointment of a patient (role "patient") or caregiver, oldest first
+    @staticmethod
+    def get_appointments(role, username, start=None, end=None):
+        return list(Appointment.iter_appointments(role, username, start, end))
+
+    # Appointments of a patient (role "patient") or caregiver by date, then
+    # ID, yielded as the rows arrive; the connection is held until the
+    # generator is exhausted or closed. Only dates from start to end
+    # (inclusive, either may be None) and, for the next page of a listing,
+    # only those after the (date, id) key of its last row. At most limit.
+    # Each role has its own query so that it seeks its own covering index,
+    # IX_Appointments_PUsername_Time or IX_Appointments_Username_Time.
+    @staticmethod
+    def iter_appointments(role, username, start=None, end=None, after=None, limit=None):
+        column = "PUsername" if role == "patient" else "Username"
+        where = [column + " = %s"]
+        params = [username]
+        if start is not None:
+            where.append("Time >= %s")
+            params.append(Caregiver._date_key(start))
+        if end is not None:
+            where.append("Time <= %s")
+            params.append(Caregiver._date_key(end))
+        if after is not None:
+            # the Time >= part lets the index seek straight to the key
+            where.append("Time >= %s AND (Time > %s OR (Time = %s AND appointmentID > %d))")
+            params.extend([after[0], after[0], after[0], after[1]])
+        get_appointments = ("SELECT appointmentID, Time, PUsername, Username FROM Appointments WHERE "
+                            + " AND ".join(where) + " ORDER BY Time, appointmentID")
+        if limit is not None:
+            get_appointments = ConnectionManager.get_backend().limit(get_appointments, limit)
+
+        with ConnectionManager() as conn:
+            cursor = conn.cursor()
+            cursor.execute(get_appointments, tuple(params))
+            for row in cursor:
+                yield Appointment(row[0], row[2], row[3], row[1])
+
+    # Cancel one of a patient's (role "patient") or caregiver's appointments
+    # and give its dose back, in one transaction. Returns the cancelled
+    # Appointment, or None if they have no appointment with that ID.
+    @staticmethod
+    def cancel(id, role, username):
+        column = "PUsername" if role == "patient" else "Username"
+        theirs = "appointmentID = %d AND " + column + " = %s"
+        # a write that changes nothing but locks the row, so the transaction
+        # holds the write lock before it reads (on SQLite, a read that later
+        # turns into a write fails at once if another writer got in between)
+        lock_appointment = "UPDATE Appointments SET Vaccine = Vaccine WHERE " + theirs
+        get_appointment = "SELECT appointmentID, Time, PUsername, Username, Vaccine FROM Appointments WHERE " + theirs
+        delete_appointment = "DELETE FROM Appointments WHERE " + theirs
+
+        with ConnectionManager() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(lock_appointment, (id, username))
+                if cursor.rowcount == 0:
+                    conn.rollback()
+                    return None
+                cursor.execute(get_appointment, (id, username))
+                row = cursor.fetchone()
+                cursor.execute(delete_appointment, (id, username))
+                if row[4] is not None:
+                    Vaccine.give_back(cursor, row[4], 1)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        appointment = Appointment(row[0], row[2], row[3], row[1], row[4])
+        # the caregiver is free on that date again
+        Caregiver.invalidate_availability(appointment.date)
+        Appointment.assignment.released(appointment.caregiver)
+        Vaccine.catalog.invalidate("all")
+        return appointment
+
+    # Cancel every appointment of a caregiver from start to end (inclusive),
+    # e.g. when they call in sick, and take away their availability on those
+    # dates. Each affected patient is moved to another caregiver free on the
+    # same date where there is one, the least booked from start on first; the
+    # rest are cancelled and their doses given back. Returns (moved,
+    # cancelled, {vaccine: doses given back}), appointments as they are
+    # afterwards, or None if there is no such caregiver.
+    #
+    # It is all set-based SQL in one transaction: appointments and free
+    # caregivers are numbered per date and paired by number into Rebookings,
+    # then moved, given back and deleted a statement at a time, so the round
+    # trips do not grow with the number of appointments.
+    @staticmethod
+    def cancel_caregiver(caregiver, start, end):
+        backend = ConnectionManager.get_backend()
+        batch = uuid.uuid4().hex
+        start = Caregiver._date_key(start)
+        end = Caregiver._date_key(end)
+        theirs = "Username = %s AND Time >= %s AND Time <= %s"
+
+        pair = ("INSERT INTO Rebookings (Batch, appointmentID, Username) "
+                "SELECT %s, X.appointmentID, F.Username FROM "
+                "(SELECT appointmentID, Time, ROW_NUMBER() OVER (PARTITION BY Time ORDER BY appointmentID) AS N "
+                "FROM Appointments WHERE " + theirs + ") X "
+                "JOIN (SELECT A.Time, A.Username, ROW_NUMBER() OVER (PARTITION BY A.Time ORDER BY "
+                "COALESCE(L.Booked, 0), A.Username) AS N FROM Availabilities A "
+                "LEFT JOIN (SELECT Username, COUNT(*) AS Booked FROM Appointments WHERE Time >= %s GROUP BY Username) L ON L.Username = A.Username "
+                "WHERE A.Username <> %s AND A.Time >= %s AND A.Time <= %s "
+                "AND NOT EXISTS (SELECT 1 FROM " + backend.lock_for_update("Appointments", "B") + " "
+                "WHERE B.Time = A.Time AND B.Username = A.Username)) F "
+                "ON F.Time = X.Time AND F.N = X.N")
+        move = ("UPDATE Appointments SET Username = (SELECT R.Username FROM Rebookings R "
+                "WHERE R.Batch = %s AND R.appointmentID = Appointments.appointmentID) "
+                "WHERE appointmentID IN (SELECT appointmentID FROM Rebookings WHERE Batch = %s)")
+        get_moved = ("SELECT A.appointmentID, A.Time, A.PUsername, A.Username, A.Vaccine FROM Rebookings R "
+                     "JOIN Appointments A ON A.appointmentID = R.appointmentID WHERE R.Batch = %s ORDER BY A.Time, A.appointmentID")
+        get_cancelled = "SELECT appointmentID, Time, PUsername, Username, Vaccine FROM Appointments WHERE " + theirs + " ORDER BY Time, appointmentID"
+        give_back = ("UPDATE Vaccines SET Doses = Doses + (SELECT COUNT(*) FROM Appointments A "
+                     "WHERE A.Username = %s AND A.Time >= %s AND A.Time <= %s AND A.Vaccine = Vaccines.Name) "
+                     "WHERE Name IN (SELECT Vaccine FROM Appointments WHERE " + theirs + ")")
+        delete_appointments = "DELETE FROM Appointments WHERE " + theirs
+        delete_availability = "DELETE FROM Availabilities WHERE " + theirs
+        forget_pairs = "DELETE FROM Rebookings WHERE Batch = %s"
+        span = (caregiver, start, end)
+
+        with ConnectionManager() as conn:
+            cursor = conn.cursor()
+            try:
+                # the pairing is written first, so the transaction holds the
+                # write lock before anything else reads
+                cursor.execute(pair, (batch,) + span + (start,) + span)
+                cursor.execute("SELECT 1 FROM Caregivers WHERE Username = %s", caregiver)
+                if cursor.fetchone() is None:
+                    conn.rollback()
+                    return None
+                cursor.execute(move, (batch, batch))
+                cursor.execute(get_moved, batch)
+                moved = [Appointment(row[0], row[2], row[3], row[1], row[4]) for row in cursor.fetchall()]
+                cursor.execute(get_cancelled, span)
+                cancelled = [Appointment(row[0], row[2], row[3], row[1], row[4]) for row in cursor.fetchall()]
+                cursor.execute(give_back, span + span)
+                cursor.execute(delete_appointments, span)
+                cursor.execute(delete_availability, span)
+                cursor.execute(forget_pairs, batch)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                Caregiver.availability_cache.clear()
+                Appointment.assignment.reset()
+                Vaccine.catalog.invalidate("all")
+
+        given_back = {}
+        for appointment in cancelled:
+            if appointment.vaccine is not None:
+                given_back[appointment.vaccine] = given_back.get(appointment.vaccine, 0) + 1
+        return moved, cancelled, given_back
+
+    # Book the patient with a free caregiver on the date and use up one dose,
+    # all in one transaction: either everything happens or nothing does.
+    # With a caregiver given, only that caregiver will do.
+    @staticmethod
+    def reserve(patient, date, vaccine_name, caregiver=None):
+        backend = ConnectionManager.get_backend()
+        get_vaccine = "SELECT Doses FROM Vaccines WHERE Name = %s"
+        # the caregiver is checked and booked by the same statement, so nobody
+        # else can book them in between
+        free = ("FROM Availabilities A WHERE A.Time = %s AND NOT EXISTS (SELECT 1 FROM " + backend.lock_for_update("Appointments", "B") + " "
+                "WHERE B.Time = A.Time AND B.Username = A.Username)")
+        book_caregiver = ("INSERT INTO Appointments (appointmentID, Time, PUsername, Username, Vaccine) "
+                          "SELECT %d, A.Time, %s, A.Username, %s " + free + " AND A.Username = %s")
+        book_any_caregiver = backend.limit(
+            "INSERT INTO Appointments (appointmentID, Time, PUsername, Username, Vaccine) "
+            "SELECT %d, A.Time, %s, A.Username, %s " + free + " ORDER BY A.Username", 1)
+        get_caregiver = "SELECT Username FROM Appointments WHERE appointmentID = %d"
+
+        # taken before checking out a connection: a new block of IDs and the
+        # free caregivers (on a cache miss) need one too
+        id = Appointment.ids.next_id()
+        if caregiver is not None:
+            candidates = [caregiver]
+        else:
+            candidates = Appointment.assignment.candidates(Caregiver._date_key(date), Caregiver(None).get_availability(date))
+
+        booked = None
+        with ConnectionManager() as conn:
+            cursor = conn.cursor()
+            try:
+                if not Vaccine.take_doses(cursor, vaccine_name):
+                    cursor.execute(get_vaccine, vaccine_name)
+                    if cursor.fetchone() is None:
+                        raise ValueError("No such vaccine")
+                    raise ValueError("Not enough available doses!")
+
+                for candidate in candidates:
+                    cursor.execute(book_caregiver, (id, patient, vaccine_name, date, candidate))
+                    if cursor.rowcount > 0:
+                        booked = candidate
+                        break
+                if booked is None and caregiver is not None:
+                    raise ValueError("That caregiver is not available on that date")
+                if booked is None:
+                    # every candidate was taken meanwhile; settle for anyone free
+                    cursor.execute(book_any_caregiver, (id, patient, vaccine_name, date))
+                    if cursor.rowcount == 0:
+                        raise ValueError("No available caregivers found for that date")
+                    cursor.execute(get_caregiver, id)
+                    booked = cursor.fetchone()[0]
+                conn.commit()
+                Vaccine.catalog.invalidate("all")
+            except BaseException:
+                conn.rollback()
+                # the cached list of free caregivers may have been stale
+                Caregiver.invalidate_availability(date)
+                raise
+        Appointment.assignment.booked(booked)
+        if candidates and booked == candidates[0]:
+            Caregiver.booked_availability(date, booked)
+        else:
+            # some candidates were taken already, so the cached list was stale
+            Caregiver.invalidate_availability(date)
+        return Appointment(id, patient, booked, date, vaccine_name)
+
+    # Book many (patient, date, vaccine_name) requests in one transaction, for
+    # mass vaccination events. Returns a result per request, in order: its
+    # Appointment, or why it could not be booked. Doses are taken per vaccine
+    # and caregivers picked per date in bulk, and all the appointments are
+    # inserted with one executemany, so the batch costs a handful of round
+    # trips however many requests it holds. Requests are served in order, so
+    # when doses or caregivers run out the later ones miss out.
+    @staticmethod
+    def reserve_batch(requests):
+        backend = ConnectionManager.get_backend()
+        get_free = ("SELECT A.Time, A.Username FROM Availabilities A WHERE A.Time >= %s AND A.Time <= %s "
+                    "AND NOT EXISTS (SELECT 1 FROM " + backend.lock_for_update("Appointments", "B") + " "
+                    "WHERE B.Time = A.Time AND B.Username = A.Username)")
+        add_appointment = "INSERT INTO Appointments (appointmentID, Time, PUsername, Username, Vaccine) VALUES (%d, %s, %s, %s, %s)"
+
+        results = [None] * len(requests)
+        days = [Caregiver._date_key(date) for patient, date, vaccine_name in requests]
+        patients = Repository.users("patient", [patient for patient, date, vaccine_name in requests])
+        wanted = {}
+        for i, (patient, date, vaccine_name) in enumerate(requests):
+            if patient not in patients:
+                results[i] = "No such patient"
+            else:
+                wanted[vaccine_name] = wanted.get(vaccine_name, 0) + 1
+        # taken before checking out a connection, as in reserve
+        ids = [Appointment.ids.next_id() for _ in range(sum(wanted.values()))]
+        loads = Appointment.assignment.loads()
+
+        booked = []
+        with ConnectionManager() as conn:
+            cursor = conn.cursor()
+            try:
+                # doses first, so the batch holds the write locks before it
+                # reads; by name, so concurrent batches lock in the same order
+                # and cannot deadlock
+                doses = {vaccine_name: Vaccine.take_up_to(cursor, vaccine_name, num) for vaccine_name, num in sorted(wanted.items())}
+                free = {}
+                if wanted:
+                    cursor.execute(get_free, (min(days), max(days)))
+                    for row in cursor.fetchall():
+                        free.setdefault(Caregiver._date_key(row[0]), set()).add(row[1])
+
+                rows = []
+                for i, (patient, date, vaccine_name) in enumerate(requests):
+                    if results[i] is not None:
+                        continue
+                    if doses[vaccine_name] is None:
+                        results[i] = "No such vaccine"
+                        continue
+                    if doses[vaccine_name] == 0:
+                        results[i] = "Not enough available doses!"
+                        continue
+                    candidates = Appointment.assignment.candidates(days[i], list(free.get(days[i], ())), loads)
+                    if not candidates:
+                        results[i] = "No available caregivers found for that date"
+                        continue
+                    caregiver = candidates[0]
+                    free[days[i]].discard(caregiver)
+                    doses[vaccine_name] -= 1
+                    Appointment.assignment.booked(caregiver)
+                    booked.append(caregiver)
+                    rows.append((ids[len(rows)], days[i], patient, caregiver, vaccine_name))
+                    results[i] = Appointment(rows[-1][0], patient, caregiver, date, vaccine_name)
+
+                for vaccine_name, left in doses.items():
+                    if left:
+                        Vaccine.give_back(cursor, vaccine_name, left)
+                if rows:
+                    cursor.executemany(add_appointment, rows)
+                conn.commit()
+                Vaccine.catalog.invalidate("all")
+            except BaseException:
+                conn.rollback()
+                for caregiver in booked:
+                    Appointment.assignment.released(caregiver)
+                raise
+            finally:
+                for day in set(days):
+                    Caregiver.invalidate_availability(day)
+        return results
@@ -0,0 +1,134 @@
+import datetime
+import heapq
+import os
+import random
+import sys
+import threading
+import time
+sys.path.append("../db/*")
+from db.ConnectionManager import ConnectionManager
+
+
+class FirstAvailable:
+    # the old behaviour: the free caregiver first by username
+    name = "first"
+
+    def choose(self, free, loads, date, n):
+        return sorted(free)[:n]
+
+
+class LeastLoaded:
+    # the free caregivers with the fewest upcoming appointments, ties by username
+    name = "least_loaded"
+
+    def choose(self, free, loads, date, n):
+        return heapq.nsmallest(n, free, key=lambda caregiver: (loads.get(caregiver, 0), caregiver))
+
+
+class RoundRobin:
+    # each booking starts one caregiver further down the free list than the last
+    name = "round_robin"
+
+    def __init__(self):
+        self.turn = 0
+        self.lock = threading.Lock()
+
+    def choose(self, free, loads, date, n):
+        with self.lock:
+            turn = self.turn
+            self.turn += 1
+        free = sorted(free)
+        start = turn % len(free)
+        return (free[start:] + free[:start])[:n]
+
+
+class RandomWithRetry:
+    # n different free caregivers in random order
+    name = "random"
+
+    def choose(self, free, loads, date, n):
+        return random.sample(free, min(n, len(free)))
+
+
+POLICIES = {policy.name: policy for policy in [FirstAvailable, LeastLoaded, RoundRobin, RandomWithRetry]}
+
+
+class AssignmentEngine:
+    '''
+    Picks the caregiver for a reservation, so bookings on a date spread over
+    its free caregivers instead of all going to the first by username (and
+    all queuing on that caregiver's rows).
+
+    candidates() orders up to retries of the date's free caregivers (from the
+    availability cache, so no query) by the policy (AssignmentPolicy):
+      - least_loaded: fewest upcoming appointments first (see below),
+      - round_robin: rotating through the free list booking by booking,
+      - random: a random order, so concurrent bookings rarely collide,
+      - first: by username, as before.
+    Appointment.reserve books the first one still free and falls back to any
+    free caregiver after that, so a stale choice costs a retry, never a
+    wrong booking.
+
+    A caregiver's load is their number of upcoming appointments, from today
+    on. Past appointments do not count: with them, a newly added caregiver
+    would take every booking until they had caught up with their colleagues'
+    whole history. Upcoming appointments are bounded by how far ahead
+    availability is uploaded, so a newcomer levels out within that window.
+
+    The counts are loaded once and then kept up to date by booked() and
+    released(). Bookings by other processes are picked up when the counts are
+    reloaded, every AssignmentLoadTTL seconds. Choosing costs
+    O(free caregivers) per booking, over the date's cached free list, rather
+    than keeping a per-date priority queue in step with every process's
+    bookings and cancellations.
+    '''
+
+    def __init__(self, policy=None, retries=None, load_ttl=None):
+        name = policy or os.getenv("AssignmentPolicy", "least_loaded")
+        if name not in POLICIES:
+            raise ValueError("Unknown assignment policy: " + name)
+        self.policy = POLICIES[name]()
+        self.retries = retries or int(os.getenv("AssignmentRetries", "3"))
+        self.load_ttl = load_ttl or float(os.getenv("AssignmentLoadTTL", "300"))
+        self._loads = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with ConnectionManager() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT Username, COUNT(*) FROM Appointments WHERE Time >= %s GROUP BY Username", datetime.date.today())
+            return {row[0]: row[1] for row in cursor.fetchall()}
+
+    def loads(self):
+        with self._lock:
+            if self._loads is not None and time.monotonic() - self._loaded_at < self.load_ttl:
+                return self._loads
+        loads = self._load()
+        with self._lock:
+            self._loads = loads
+            self._loaded_at = time.monotonic()
+            return loads
+
+    def candidates(self, date, free, loads=None):
+        # the caregivers to try for a booking on date, best first; pass loads
+        # (from loads()) when holding a connection, so a reload cannot need a
+        # second one from the pool
+        if not free:
+            return []
+        return self.policy.choose(free, loads if loads is not None else self.loads(), date, self.retries)
+
+    def booked(self, caregiver):
+        with self._lock:
+            if self._loads is not None:
+                self._loads[caregiver] = self._loads.get(caregiver, 0) + 1
+
+    def reset(self):
+        # reload the counts on next use, after bulk changes made in SQL
+        with self._lock:
+            self._loads = None
+
+    def released(self, caregiver):
+        with self._lock:
+            if self._loads is not None and self._loads.get(caregiver, 0) > 0:
+                self._loads[caregiver] -= 1
@@ -1,45 +1,72 @@
+import datetime
+import os
 import sys
 sys.path.append("../util/*")
 sys.path.append("../db/*")
-from util.Util import Util
+from util.Cache import Cache
+from util.PasswordHasher import get_hasher
 from db.ConnectionManager import ConnectionManager
-import pymssql
+from db.Backend import DBError
+from model.Repository import Repository
 
 
 class Caregiver:
-    def __init__(self, username, password=None, salt=None, hash=None):
+    __slots__ = ("username", "password", "salt", "hash", "hash_params")
+
+    # free caregivers by date, for searches. Uploads, bookings and cancellations
+    # in this process invalidate the dates they touch; the TTL bounds how stale
+    # an entry can get from other processes' writes. Set AvailabilityConsistency
+    # to "strict" to always read through to the database instead. Either way,
+    # reserve checks availability in the database, so a stale entry is never
+    # booked.
+    availability_cache = Cache("availability",
+                               max_size=int(os.getenv("AvailabilityCacheSize", "366")),
+                               ttl=float(os.getenv("AvailabilityCacheTTL", "10")))
+    strict_availability = os.getenv("AvailabilityConsistency", "fast").lower() == "strict"
+
+    def __init__(self, username, password=None, salt=None, hash=None, hash_params=None):
         self.username = username
         self.password = password
         self.salt = salt
         self.hash = hash
+        self.hash_params = hash_params
 
     # getters
     def get(self):
         cm = ConnectionManager()
         conn = cm.create_connection()
         cursor = conn.cursor(as_dict=True)
+        hasher = get_hasher()
 
-        get_caregiver_details = "SELECT Salt, Hash FROM Caregivers WHERE Username = %s"
+        get_caregiver_details = "SELECT Salt, Hash, HashParams FROM Caregivers WHERE Username = %s"
+        upgrade_hash = "UPDATE Caregivers SET Hash = %s, HashParams = %s WHERE Username = %s"
         try:
             cursor.execute(get_caregiver_details, self.username)
-            for row in cursor:
-                curr_salt = row['Salt']
-                curr_hash = row['Hash']
-                calculated_hash = Util.generate_hash(self.password, curr_salt)
-                if not curr_hash == calculated_hash:
-                    # print("Incorrect password")
-                    cm.close_connection()
-                    return None
-                else:
-                    self.salt = curr_salt
-                    self.hash = calculated_hash
-                    cm.close_connection()
-                    return self
-        except pymssql.Error as e:
+            row = cursor.fetchone()
+            # don't hold a pooled connection while hashing
+            cm.close_connection()
+            if row is None:
+                return None
+            curr_salt = row['Salt']
+            curr_hash = row['Hash']
+            if not hasher.verify(self.password, curr_salt, curr_hash, row['HashParams']):
+                # print("Incorrect password")
+                return None
+            self.salt = curr_salt
+            self.hash = curr_hash
+            self.hash_params = row['HashParams'] or hasher.LEGACY_PARAMS
+            # rehash with the current cost while we have the password
+            if hasher.needs_upgrade(self.hash_params):
+                self.hash = hasher.hash(self.password, curr_salt)
+                self.hash_params = hasher.params
+                with ConnectionManager() as conn:
+                    conn.cursor().execute(upgrade_hash, (self.hash, self.hash_params, self.username))
+                    conn.commit()
+            return self
+        except DBError as e:
             raise e
         finally:
             cm.close_connection()
-        return None
 
     def get_username(self):
         return self.username
@@ -50,56 +77,127 @@ class Caregiver:
     def get_hash(self):
         return self.hash
 
+    def get_hash_params(self):
+        return self.hash_params
+
     def save_to_db(self):
         cm = ConnectionManager()
         conn = cm.create_connection()
         cursor = conn.cursor()
 
-        add_caregivers = "INSERT INTO Caregivers VALUES (%s, %s, %s)"
+        add_caregivers = "INSERT INTO Caregivers (Username, Salt, Hash, HashParams) VALUES (%s, %s, %s, %s)"
         try:
-            cursor.execute(add_caregivers, (self.username, self.salt, self.hash))
+            cursor.execute(add_caregivers, (self.username, self.salt, self.hash, self.hash_params))
             # you must call commit() to persist your data if you don't set autocommit to True
             conn.commit()
-        except pymssql.Error:
+        except DBError:
+            raise
+        finally:
+            cm.close_connection()
+
+    # Insert many users in one transaction, skipping usernames that are taken;
+    # returns the number of users inserted
+    @staticmethod
+    def save_all(users):
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+        cursor = conn.cursor()
+
+        add_caregivers = "INSERT INTO Caregivers (Username, Salt, Hash, HashParams) SELECT %s, %s, %s, %s WHERE NOT EXISTS (SELECT 1 FROM Caregivers WHERE Username = %s)"
+        try:
+            cursor.executemany(add_caregivers, [(u.username, u.salt, u.hash, u.hash_params, u.username) for u in users])
+            inserted = cursor.rowcount
+            conn.commit()
+            return inserted
+        except DBError:
+            conn.rollback()
             raise
         finally:
             cm.close_connection()
 
     # Insert availability with parameter date d
     def upload_availability(self, d):
+        return self.upload_availabilities([d])
+
+    # Insert availability for every date in dates in one transaction, skipping
+    # dates that are already uploaded; returns the number of rows inserted
+    def upload_availabilities(self, dates):
         cm = ConnectionManager()
         conn = cm.create_connection()
         cursor = conn.cursor()
 
-        add_availability = "INSERT INTO Availabilities VALUES (%s , %s)"
+        add_availability = "INSERT INTO Availabilities (Time, Username) SELECT %s, %s WHERE NOT EXISTS (SELECT 1 FROM Availabilities WHERE Time = %s AND Username = %s)"
         try:
-            cursor.execute(add_availability, (d, self.username))
+            cursor.executemany(add_availability, [(d, self.username, d, self.username) for d in dates])
+            inserted = cursor.rowcount
             # you must call commit() to persist your data if you don't set autocommit to True
             conn.commit()
-        except pymssql.Error:
+            for d in dates:
+                Caregiver.invalidate_availability(d)
+            return inserted
+        except DBError:
             # print("Error occurred when updating caregiver availability")
             raise
         finally:
             cm.close_connection()
 
+    @staticmethod
+    def _date_key(date):
+        return date.date() if isinstance(date, datetime.datetime) else date
+
+    @staticmethod
+    def invalidate_availability(date):
+        Caregiver.availability_cache.invalidate(Caregiver._date_key(date))
+
+    @staticmethod
+    def booked_availability(date, username):
+        # username was just booked on date: drop them from its cached free list
+        Caregiver.availability_cache.update(Caregiver._date_key(date), lambda free: [c for c in free if c != username])
+
     def get_availability(self, date):
+        key = Caregiver._date_key(date)
+        if Caregiver.strict_availability:
+            return Caregiver._load_availability(key)
+        # copies, so callers can't change the cached list
+        return list(Caregiver.availability_cache.get_or_load(key, lambda: Caregiver._load_availability(key)))
+
+    @staticmethod
+    def _load_availability(date):
         cm = ConnectionManager()
         conn = cm.create_connection()
         cursor = conn.cursor(as_dict=True)
         toReturn = []
 
-        get_availability = "SELECT A.Username FROM Availabilities A WHERE A.Username NOT IN (select distinct a2.Username FROM Appointments a2 Where a2.Time = %s) AND A.Time = %s ORDER BY A.Username ; "
+        # anti-join: both sides are index seeks on (Time, Username)
+        get_availability = "SELECT A.Username FROM Availabilities A WHERE A.Time = %s AND NOT EXISTS (SELECT 1 FROM Appointments B WHERE B.Time = A.Time AND B.Username = A.Username) ORDER BY A.Username"
         try:
-            cursor.execute(get_availability, (date, date))
+            cursor.execute(get_availability, date)
 
             # Saved values
             for row in cursor:
                 toReturn.append(str(row['Username']))
             return toReturn
 
-        except pymssql.Error:
+        except DBError as e:
             print("Error occurred when retrieving caregiver availability")
-            print(pymssql.Error)
+            print(e)
             raise
         finally:
             cm.close_connection()
+
+    # (date, [usernames]) for every date from start to end with a free
+    # caregiver, from one query and yielded as the rows arrive. The connection
+    # is held until the generator is exhausted or closed.
+    @staticmethod
+    def get_availability_range(start, end):
+        day = None
+        usernames = []
+        for slot in Repository.availability_between(start, end):
+            if slot.time != day:
+                if usernames:
+                    yield day, usernames
+                day = slot.time
+                usernames = []
+            usernames.append(str(slot.caregiver))
+        if usernames:
+            yield day, usernames
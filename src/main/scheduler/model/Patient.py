@@ -1,17 +1,20 @@
 import sys
 sys.path.append("../util/*")
 sys.path.append("../db/*")
-from util.Util import Util
+from util.PasswordHasher import get_hasher
 from db.ConnectionManager import ConnectionManager
-import pymssql
+from db.Backend import DBError
 
 
 class Patient:
-    def __init__(self, username, password=None, salt=None, hash=None):
+    __slots__ = ("username", "password", "salt", "hash", "hash_params")
+
+    def __init__(self, username, password=None, salt=None, hash=None, hash_params=None):
         self.username = username
         self.password = password
         self.salt = salt
         self.hash = hash
+        self.hash_params = hash_params
 
     def get_username(self):
         return self.username
@@ -22,44 +25,76 @@ class Patient:
     def get_hash(self):
         return self.hash
 
+    def get_hash_params(self):
+        return self.hash_params
+
     def get(self):
         cm = ConnectionManager()
         conn = cm.create_connection()
         cursor = conn.cursor(as_dict=True)
+        hasher = get_hasher()
 
-        get_Pateint_details = "SELECT Salt, Hash FROM Patients WHERE PUsername = %s"
+        get_Pateint_details = "SELECT Salt, Hash, HashParams FROM Patients WHERE PUsername = %s"
+        upgrade_hash = "UPDATE Patients SET Hash = %s, HashParams = %s WHERE PUsername = %s"
         try:
             cursor.execute(get_Pateint_details, self.username)
-            for row in cursor:
-                curr_salt = row['Salt']
-                curr_hash = row['Hash']
-                calculated_hash = Util.generate_hash(self.password, curr_salt)
-                if not curr_hash == calculated_hash:
-                    # print("Incorrect password")
-                    cm.close_connection()
-                    return None
-                else:
-                    self.salt = curr_salt
-                    self.hash = calculated_hash
-                    cm.close_connection()
-                    return self
-        except pymssql.Error as e:
+            row = cursor.fetchone()
+            # don't hold a pooled connection while hashing
+            cm.close_connection()
+            if row is None:
+                return None
+            curr_salt = row['Salt']
+            curr_hash = row['Hash']
+            if not hasher.verify(self.password, curr_salt, curr_hash, row['HashParams']):
+                # print("Incorrect password")
+                return None
+            self.salt = curr_salt
+            self.hash = curr_hash
+            self.hash_params = row['HashParams'] or hasher.LEGACY_PARAMS
+            # rehash with the current cost while we have the password
+            if hasher.needs_upgrade(self.hash_params):
+                self.hash = hasher.hash(self.password, curr_salt)
+                self.hash_params = hasher.params
+                with ConnectionManager() as conn:
+                    conn.cursor().execute(upgrade_hash, (self.hash, self.hash_params, self.username))
+                    conn.commit()
+            return self
+        except DBError as e:
             raise e
         finally:
             cm.close_connection()
-        return None
 
     def save_to_db(self):
         cm = ConnectionManager()
         conn = cm.create_connection()
         cursor = conn.cursor()
 
-        add_patient = "INSERT INTO Patients VALUES (%s, %s, %s)"
+        add_patient = "INSERT INTO Patients (PUsername, Salt, Hash, HashParams) VALUES (%s, %s, %s, %s)"
         try:
-            cursor.execute(add_patient, (self.username, self.salt, self.hash))
+            cursor.execute(add_patient, (self.username, self.salt, self.hash, self.hash_params))
             # you must call commit() to persist your data if you don't set autocommit to True
             conn.commit()
-        except pymssql.Error:
+        except DBError:
+            raise
+        finally:
+            cm.close_connection()
+
+    # Insert many users in one transaction, skipping usernames that are taken;
+    # returns the number of users inserted
+    @staticmethod
+    def save_all(users):
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+        cursor = conn.cursor()
+
+        add_patient = "INSERT INTO Patients (PUsername, Salt, Hash, HashParams) SELECT %s, %s, %s, %s WHERE NOT EXISTS (SELECT 1 FROM Patients WHERE PUsername = %s)"
+        try:
+            cursor.executemany(add_patient, [(u.username, u.salt, u.hash, u.hash_params, u.username) for u in users])
+            inserted = cursor.rowcount
+            conn.commit()
+            return inserted
+        except DBError:
+            conn.rollback()
             raise
         finally:
             cm.close_connection()
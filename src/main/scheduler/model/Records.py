@@ -0,0 +1,20 @@
+from collections import namedtuple
+
+
+'''
+Read-only row types for bulk queries, see model/Repository.py.
+
+Each is a named tuple: no per-instance dict (__slots__ is empty), about the
+size of a plain tuple, and built straight from a cursor row with _make. That
+is still one Python call per row, but a short one (tuple.__new__ plus a
+length check) rather than an __init__ assigning each attribute. The field
+order matches the SELECT list of the queries that produce them.
+'''
+
+AppointmentRecord = namedtuple("AppointmentRecord", ["id", "time", "patient", "caregiver"])
+
+AvailabilityRecord = namedtuple("AvailabilityRecord", ["time", "caregiver"])
+
+VaccineRecord = namedtuple("VaccineRecord", ["name", "doses"])
+
+UserRecord = namedtuple("UserRecord", ["username", "salt", "hash", "hash_params"])
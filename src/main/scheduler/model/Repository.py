@@ -0,0 +1,113 @@
+import os
+import sys
+sys.path.append("../db/*")
+from db.ConnectionManager import ConnectionManager
+from model.Vaccine import Vaccine
+from model.Records import AppointmentRecord, AvailabilityRecord, VaccineRecord, UserRecord
+
+
+class Repository:
+    '''
+    Batch reads for reports and bulk jobs, returning the records in
+    model/Records.py rather than model objects.
+
+    Range queries are generators: they fetch batch_size rows at a time
+    (RepositoryBatchSize) and hold their connection until exhausted or
+    closed, so a report over hundreds of thousands of appointments never
+    has them all in memory unless it asks for a list. Lookups by many keys
+    run one query per chunk of IN_CHUNK keys rather than one per key.
+    '''
+
+    # stays well under SQL Server's 2100 parameters per statement
+    IN_CHUNK = 500
+
+    @staticmethod
+    def _batch_size(batch_size):
+        return batch_size or int(os.getenv("RepositoryBatchSize", "1000"))
+
+    @staticmethod
+    def _chunks(values, size):
+        values = list(dict.fromkeys(values))
+        for i in range(0, len(values), size):
+            yield values[i:i + size]
+
+    @staticmethod
+    def _placeholders(values):
+        return ", ".join(["%s"] * len(values))
+
+    @staticmethod
+    def _stream(query, params, record, batch_size):
+        with ConnectionManager() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from map(record._make, rows)
+
+    @staticmethod
+    def _fetch_in(query, keys, record):
+        # query has one "{keys}" to fill with an IN list; all rows, as records
+        records = []
+        with ConnectionManager() as conn:
+            cursor = conn.cursor()
+            for chunk in Repository._chunks(keys, Repository.IN_CHUNK):
+                cursor.execute(query.format(keys=Repository._placeholders(chunk)), tuple(chunk))
+                records.extend(map(record._make, cursor.fetchall()))
+        return records
+
+    # every appointment from start to end inclusive, by date then ID
+    @staticmethod
+    def appointments_between(start, end, batch_size=None):
+        get_appointments = "SELECT appointmentID, Time, PUsername, Username FROM Appointments WHERE Time >= %s AND Time <= %s ORDER BY Time, appointmentID"
+        return Repository._stream(get_appointments, (start, end), AppointmentRecord, Repository._batch_size(batch_size))
+
+    # {appointment ID: record} for the IDs that exist
+    @staticmethod
+    def appointments_by_id(ids):
+        get_appointments = "SELECT appointmentID, Time, PUsername, Username FROM Appointments WHERE appointmentID IN ({keys})"
+        return {r.id: r for r in Repository._fetch_in(get_appointments, ids, AppointmentRecord)}
+
+    # {username: [records, oldest first]} for many patients (role "patient") or caregivers
+    @staticmethod
+    def appointments_for(role, usernames):
+        column = "PUsername" if role == "patient" else "Username"
+        get_appointments = "SELECT appointmentID, Time, PUsername, Username FROM Appointments WHERE " + column + " IN ({keys}) ORDER BY appointmentID"
+        by_user = {username: [] for username in usernames}
+        for record in Repository._fetch_in(get_appointments, usernames, AppointmentRecord):
+            by_user[record.patient if role == "patient" else record.caregiver].append(record)
+        return by_user
+
+    # every free (date, caregiver) slot from start to end inclusive, by date then caregiver
+    @staticmethod
+    def availability_between(start, end, batch_size=None):
+        get_availability = "SELECT A.Time, A.Username FROM Availabilities A WHERE A.Time >= %s AND A.Time <= %s AND NOT EXISTS (SELECT 1 FROM Appointments B WHERE B.Time = A.Time AND B.Username = A.Username) ORDER BY A.Time, A.Username"
+        return Repository._stream(get_availability, (start, end), AvailabilityRecord, Repository._batch_size(batch_size))
+
+    # usernames of the caregivers with at least one free date from start to end
+    @staticmethod
+    def caregivers_available_between(start, end):
+        get_caregivers = "SELECT DISTINCT A.Username FROM Availabilities A WHERE A.Time >= %s AND A.Time <= %s AND NOT EXISTS (SELECT 1 FROM Appointments B WHERE B.Time = A.Time AND B.Username = A.Username) ORDER BY A.Username"
+        with ConnectionManager() as conn:
+            cursor = conn.cursor()
+            cursor.execute(get_caregivers, (start, end))
+            return [row[0] for row in cursor.fetchall()]
+
+    # every vaccine, or just the named ones, by name
+    @staticmethod
+    def vaccines(names=None):
+        if names is not None:
+            get_vaccines = "SELECT V.Name, " + Vaccine.DOSES + " FROM Vaccines V WHERE V.Name IN ({keys})"
+            return sorted(Repository._fetch_in(get_vaccines, names, VaccineRecord))
+        with ConnectionManager() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT V.Name, " + Vaccine.DOSES + " FROM Vaccines V ORDER BY V.Name")
+            return list(map(VaccineRecord._make, cursor.fetchall()))
+
+    # {username: record} for the patients (role "patient") or caregivers that exist
+    @staticmethod
+    def users(role, usernames):
+        table, column = ("Patients", "PUsername") if role == "patient" else ("Caregivers", "Username")
+        get_users = "SELECT " + column + ", Salt, Hash, HashParams FROM " + table + " WHERE " + column + " IN ({keys})"
+        return {r.username: r for r in Repository._fetch_in(get_users, usernames, UserRecord)}
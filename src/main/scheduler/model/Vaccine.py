@@ -1,10 +1,24 @@
+import os
+import random
 import sys
 sys.path.append("../db/*")
+sys.path.append("../util/*")
 from db.ConnectionManager import ConnectionManager
-import pymssql
+from db.Backend import DBError
+from util.Cache import Cache
 
 
 class Vaccine:
+    __slots__ = ("vaccine_name", "available_doses")
+
+    # (name, doses) of every vaccine; anything that changes doses invalidates it
+    catalog = Cache("vaccines", max_size=1, ttl=float(os.getenv("VaccineCacheTTL", "30")))
+    # {name: number of stripes} of the striped vaccines, see set_stripes
+    stripe_counts = Cache("vaccine stripes", max_size=1, ttl=float(os.getenv("VaccineCacheTTL", "30")))
+
+    # a vaccine's available doses: its Vaccines row plus any stripes
+    DOSES = "V.Doses + COALESCE((SELECT SUM(S.Doses) FROM VaccineStripes S WHERE S.Name = V.Name), 0)"
+
     def __init__(self, vaccine_name, available_doses):
         self.vaccine_name = vaccine_name
         self.available_doses = available_doses
@@ -15,19 +29,39 @@ class Vaccine:
         conn = cm.create_connection()
         cursor = conn.cursor()
 
-        get_vaccine = "SELECT Name, Doses FROM Vaccines WHERE Name = %s"
+        get_vaccine = "SELECT V.Name, " + Vaccine.DOSES + " FROM Vaccines V WHERE V.Name = %s"
         try:
             cursor.execute(get_vaccine, self.vaccine_name)
             for row in cursor:
                 self.available_doses = row[1]
                 return self
-        except pymssql.Error:
+        except DBError:
             # print("Error occurred when getting Vaccine")
             raise
         finally:
             cm.close_connection()
         return None
 
+    # every vaccine and its available doses, from the catalog cache when possible
+    @staticmethod
+    def get_all():
+        return Vaccine.catalog.get_or_load("all", Vaccine._load_all)
+
+    @staticmethod
+    def _load_all():
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+        cursor = conn.cursor()
+
+        get_vaccines = "SELECT V.Name, " + Vaccine.DOSES + " FROM Vaccines V ORDER BY V.Name"
+        try:
+            cursor.execute(get_vaccines)
+            return [(row[0], row[1]) for row in cursor]
+        except DBError:
+            raise
+        finally:
+            cm.close_connection()
+
     def get_vaccine_name(self):
         return self.vaccine_name
 
@@ -47,7 +81,8 @@ class Vaccine:
             cursor.execute(add_doses, (self.vaccine_name, self.available_doses))
             # you must call commit() to persist your data if you don't set autocommit to True
             conn.commit()
-        except pymssql.Error:
+            Vaccine.catalog.invalidate("all")
+        except DBError:
             # print("Error occurred when insert Vaccines")
             raise
         finally:
@@ -63,37 +98,224 @@ class Vaccine:
         conn = cm.create_connection()
         cursor = conn.cursor()
 
-        update_vaccine_availability = "UPDATE vaccines SET Doses = %d WHERE name = %s"
+        # add on the server so concurrent updates are not lost
+        update_vaccine_availability = "UPDATE vaccines SET Doses = Doses + %d WHERE name = %s"
         try:
-            cursor.execute(update_vaccine_availability, (self.available_doses, self.vaccine_name))
+            cursor.execute(update_vaccine_availability, (num, self.vaccine_name))
             # you must call commit() to persist your data if you don't set autocommit to True
             conn.commit()
-        except pymssql.Error:
+            Vaccine.catalog.invalidate("all")
+        except DBError:
             # print("Error occurred when updating vaccine availability")
             raise
         finally:
             cm.close_connection()
 
-    # Decrement the available doses
+    # Add doses to many vaccines in one transaction, creating the vaccines that
+    # do not exist yet. doses is a list of (vaccine_name, num) pairs.
+    @staticmethod
+    def add_doses(doses):
+        totals = {}
+        for vaccine_name, num in doses:
+            if num <= 0:
+                raise ValueError("Argument cannot be negative!")
+            totals[vaccine_name] = totals.get(vaccine_name, 0) + num
+
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+        cursor = conn.cursor()
+
+        # create missing rows empty first, then add on the server: a vaccine
+        # another client creates in between still gets every dose
+        add_vaccine = "INSERT INTO Vaccines (Name, Doses) SELECT %s, 0 WHERE NOT EXISTS (SELECT 1 FROM Vaccines WHERE Name = %s)"
+        update_vaccine_availability = "UPDATE Vaccines SET Doses = Doses + %d WHERE Name = %s"
+        update_stripe = "UPDATE VaccineStripes SET Doses = Doses + %d WHERE Name = %s AND Stripe = %d"
+        try:
+            cursor.executemany(add_vaccine, [(name, name) for name in totals])
+            # striped vaccines get their doses spread evenly over the stripes
+            stripes = Vaccine.get_stripe_counts(cursor)
+            unstriped = [(num, name) for name, num in totals.items() if name not in stripes]
+            striped = [(num // stripes[name] + (1 if i < num % stripes[name] else 0), name, i)
+                       for name, num in totals.items() if name in stripes
+                       for i in range(stripes[name])]
+            if unstriped:
+                cursor.executemany(update_vaccine_availability, unstriped)
+            if striped:
+                cursor.executemany(update_stripe, striped)
+            conn.commit()
+            Vaccine.catalog.invalidate("all")
+        except DBError:
+            conn.rollback()
+            raise
+        finally:
+            cm.close_connection()
+        return len(totals)
+
+    # Decrement the available doses on the server, only if enough are left
     def decrease_available_doses(self, num):
-        if self.available_doses - num < 0:
-            ValueError("Not enough available doses!")
-        self.available_doses -= num
+        if num <= 0:
+            raise ValueError("Argument cannot be negative!")
 
         cm = ConnectionManager()
         conn = cm.create_connection()
         cursor = conn.cursor()
 
-        update_vaccine_availability = "UPDATE vaccines SET Doses = %d WHERE name = %s"
         try:
-            cursor.execute(update_vaccine_availability, (self.available_doses, self.vaccine_name))
+            if not Vaccine.take_doses(cursor, self.vaccine_name, num):
+                conn.rollback()
+                raise ValueError("Not enough available doses!")
             # you must call commit() to persist your data if you don't set autocommit to True
             conn.commit()
-        except pymssql.Error:
+            self.available_doses -= num
+            Vaccine.catalog.invalidate("all")
+        except DBError:
             # print("Error occurred when updating vaccine availability")
             raise
         finally:
             cm.close_connection()
 
+    # Take num doses of a vaccine with cursor's connection, in its transaction.
+    # Returns False, changing nothing, if fewer than num are left (or there is
+    # no such vaccine). The check and the decrement are one statement, so
+    # concurrent takers can neither lose an update nor drive stock negative.
+    @staticmethod
+    def take_doses(cursor, vaccine_name, num=1):
+        take = "UPDATE Vaccines SET Doses = Doses - %d WHERE Name = %s AND Doses >= %d"
+        take_stripe = "UPDATE VaccineStripes SET Doses = Doses - %d WHERE Name = %s AND Stripe = %d AND Doses >= %d"
+        get_stripes = "SELECT Stripe FROM VaccineStripes WHERE Name = %s AND Doses >= %d ORDER BY Doses DESC"
+        # the cached counts only: loading them on a miss would read before
+        # the first write, and on SQLite a transaction that reads and then
+        # writes fails at once if another writer got in between
+        counts = Vaccine.stripe_counts.get("all")
+        stripes = counts.get(vaccine_name) if counts is not None else None
+        if stripes:
+            # striped: start at a random stripe so concurrent takers spread
+            # over the rows
+            cursor.execute(take_stripe, (num, vaccine_name, random.randrange(stripes), num))
+        else:
+            cursor.execute(take, (num, vaccine_name, num))
+        taken = cursor.rowcount > 0
+        if counts is None:
+            # holding the write lock now, so reading is safe
+            Vaccine.get_stripe_counts(cursor)
+        if taken:
+            return True
+
+        # then any stripe with enough left: the cached stripe counts may be
+        # stale, another process may have striped the vaccine since they were
+        # loaded
+        cursor.execute(get_stripes, (vaccine_name, num))
+        for row in cursor.fetchall():
+            cursor.execute(take_stripe, (num, vaccine_name, row[0], num))
+            if cursor.rowcount > 0:
+                return True
+        if not stripes:
+            return False
+        # and last the Vaccines row (doses added before striping or by older clients)
+        cursor.execute(take, (num, vaccine_name, num))
+        return cursor.rowcount > 0
+
+    # Take as many of num doses of a vaccine as are left, up to num, with
+    # cursor's connection, in its transaction. Returns how many were taken, or
+    # None if there is no such vaccine. Every decrement is conditional, so
+    # stock never goes negative even if another client takes doses meanwhile.
+    @staticmethod
+    def take_up_to(cursor, vaccine_name, num):
+        if num <= 0:
+            return 0
+        if Vaccine.take_doses(cursor, vaccine_name, num):
+            return num
+
+        backend = ConnectionManager.get_backend()
+        get_vaccine = "SELECT Doses FROM " + backend.lock_for_update("Vaccines", "V") + " WHERE Name = %s"
+        get_stripes = "SELECT Stripe, Doses FROM " + backend.lock_for_update("VaccineStripes", "S") + " WHERE Name = %s AND Doses > 0"
+        take = "UPDATE Vaccines SET Doses = Doses - %d WHERE Name = %s AND Doses >= %d"
+        take_stripe = "UPDATE VaccineStripes SET Doses = Doses - %d WHERE Name = %s AND Stripe = %d AND Doses >= %d"
+
+        cursor.execute(get_vaccine, vaccine_name)
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        # what is left, drained stripe by stripe and then from the Vaccines row
+        # read the stripes rather than trust the cached counts, which may
+        # predate another process striping the vaccine
+        cursor.execute(get_stripes, vaccine_name)
+        sources = [(take_stripe, (vaccine_name, r[0]), r[1]) for r in cursor.fetchall()]
+        sources.append((take, (vaccine_name,), row[0]))
+
+        taken = 0
+        for statement, key, doses in sources:
+            n = min(num - taken, doses)
+            if n <= 0:
+                continue
+            cursor.execute(statement, (n,) + key + (n,))
+            if cursor.rowcount > 0:
+                taken += n
+        return taken
+
+    # Put back doses taken with cursor's connection but not used
+    @staticmethod
+    def give_back(cursor, vaccine_name, num):
+        if num > 0:
+            cursor.execute("UPDATE Vaccines SET Doses = Doses + %d WHERE Name = %s", (num, vaccine_name))
+
+    # loads with cursor on a miss: a caller holding a connection must not
+    # wait for a second one from the pool
+    @staticmethod
+    def get_stripe_counts(cursor):
+        return Vaccine.stripe_counts.get_or_load("all", lambda: Vaccine._load_stripe_counts(cursor))
+
+    @staticmethod
+    def _load_stripe_counts(cursor):
+        cursor.execute("SELECT Name, COUNT(*) FROM VaccineStripes GROUP BY Name")
+        return {row[0]: row[1] for row in cursor.fetchall()}
+
+    # Split a vaccine's doses over stripes rows of VaccineStripes, so that
+    # concurrent reservations of a very popular vaccine update different rows
+    # instead of queuing on one. stripes 1 puts them back in the Vaccines row.
+    # Other processes pick the change up within VaccineCacheTTL; until then
+    # they try the Vaccines row first and fall back to the stripes when it is
+    # empty, so they still take doses correctly, one statement slower.
+    @staticmethod
+    def set_stripes(vaccine_name, stripes):
+        if stripes <= 0:
+            raise ValueError("Argument cannot be negative!")
+        backend = ConnectionManager.get_backend()
+        lock_vaccine = "UPDATE Vaccines SET Doses = Doses WHERE Name = %s"
+        get_vaccine = "SELECT Doses FROM " + backend.lock_for_update("Vaccines", "V") + " WHERE Name = %s"
+        get_striped = "SELECT COALESCE(SUM(Doses), 0) FROM " + backend.lock_for_update("VaccineStripes", "S") + " WHERE Name = %s"
+        delete_stripes = "DELETE FROM VaccineStripes WHERE Name = %s"
+        set_doses = "UPDATE Vaccines SET Doses = %d WHERE Name = %s"
+        add_stripe = "INSERT INTO VaccineStripes (Name, Stripe, Doses) VALUES (%s, %d, %d)"
+
+        cm = ConnectionManager()
+        conn = cm.create_connection()
+        cursor = conn.cursor()
+        try:
+            # write first, so the transaction holds the write lock before it reads
+            cursor.execute(lock_vaccine, vaccine_name)
+            if cursor.rowcount == 0:
+                raise ValueError("No such vaccine")
+            cursor.execute(get_vaccine, vaccine_name)
+            row = cursor.fetchone()
+            cursor.execute(get_striped, vaccine_name)
+            total = row[0] + cursor.fetchone()[0]
+            cursor.execute(delete_stripes, vaccine_name)
+            if stripes == 1:
+                cursor.execute(set_doses, (total, vaccine_name))
+            else:
+                cursor.execute(set_doses, (0, vaccine_name))
+                cursor.executemany(add_stripe, [(vaccine_name, i, total // stripes + (1 if i < total % stripes else 0))
+                                                for i in range(stripes)])
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            cm.close_connection()
+            Vaccine.stripe_counts.clear()
+            Vaccine.catalog.invalidate("all")
+        return total
+
     def __str__(self):
         return f"(Vaccine Name: {self.vaccine_name}, Available Doses: {self.available_doses})"
@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class Cache:
+    '''
+    A thread-safe, in-process LRU cache whose entries also expire after ttl
+    seconds. Holds at most max_size entries; the least recently used one is
+    dropped to make room. Counts hits and misses for stats().
+    '''
+
+    def __init__(self, name, max_size=1024, ttl=60):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # bumped by every invalidation, so a load that raced one is not kept
+        self._generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._put(key, value)
+
+    def _put(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_or_load(self, key, load):
+        # the cached value, or load() stored and returned on a miss
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            generation = self._generation
+            value = load()
+            with self._lock:
+                if generation == self._generation:
+                    self._put(key, value)
+        return value
+
+    def update(self, key, change):
+        # replace a cached value with change(value), keeping its expiry; like
+        # invalidate(), a load that raced this is not kept
+        with self._lock:
+            self._generation += 1
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (entry[0], change(entry[1]))
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
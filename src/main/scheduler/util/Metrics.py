@@ -0,0 +1,189 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# seconds; the last bucket is +Inf
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+NO_COMMAND = "none"
+
+_command = contextvars.ContextVar("command", default=NO_COMMAND)
+
+
+def current_command():
+    # name of the command running in this context, or "none" outside one
+    return _command.get()
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    '''
+    A thread-safe registry of counters, histograms and gauges, rendered in
+    the Prometheus text format by render().
+
+    Metrics are identified by name plus labels, e.g.
+        metrics.inc("scheduler_db_queries_total", command="reserve")
+    Gauges are read when rendering, from a function registered with gauge().
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    def describe(self, name, type, help):
+        with self._lock:
+            self._types[name] = type
+            self._help[name] = help
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def gauge(self, name, read, help):
+        self.describe(name, "gauge", help)
+        with self._lock:
+            self._gauges[name] = read
+
+    def value(self, name, **labels):
+        # a counter's current value, 0 if it was never incremented
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def command(self, name):
+        # time a command and attribute the queries it runs to it
+        token = _command.set(name)
+        try:
+            with self.timer("scheduler_command_seconds", command=name):
+                yield
+        finally:
+            _command.reset(token)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join('{0}="{1}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + "}"
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            gauges = sorted(self._gauges.items())
+            types = dict(self._types)
+            help = dict(self._help)
+
+        lines = []
+        described = set()
+
+        def header(name, default_type):
+            if name not in described:
+                described.add(name)
+                if name in help:
+                    lines.append("# HELP {0} {1}".format(name, help[name]))
+                lines.append("# TYPE {0} {1}".format(name, types.get(name, default_type)))
+
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append("{0}{1} {2}".format(name, self._labels(labels), value))
+        for (name, labels), histogram in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                cumulative += count
+                lines.append("{0}_bucket{1} {2}".format(name, self._labels(labels, [("le", bound)]), cumulative))
+            lines.append("{0}_sum{1} {2:.6f}".format(name, self._labels(labels), histogram.sum))
+            lines.append("{0}_count{1} {2}".format(name, self._labels(labels), histogram.count))
+        for name, read in gauges:
+            header(name, "gauge")
+            lines.append("{0} {1}".format(name, read()))
+        return "\n".join(lines) + "\n"
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_metrics():
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Metrics()
+            _default.describe("scheduler_command_seconds", "histogram", "Time taken by each command.")
+            _default.describe("scheduler_db_connections_opened_total", "counter", "Database connections opened.")
+            _default.describe("scheduler_db_queries_total", "counter", "Statements executed, by calling command.")
+            _default.describe("scheduler_db_rows_fetched_total", "counter", "Rows fetched, by calling command.")
+            _default.describe("scheduler_db_slow_queries_total", "counter", "Statements slower than SlowQueryMs, by calling command.")
+            _default.describe("scheduler_db_commits_total", "counter", "Transactions committed, by calling command.")
+            _default.describe("scheduler_db_pool_wait_seconds", "histogram", "Time spent checking a connection out of the pool.")
+            _default.describe("scheduler_password_hash_seconds", "histogram", "Time taken by each PBKDF2 derivation.")
+        return _default
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = get_metrics().render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(host, port):
+    # serve GET /metrics on a background thread; returns the server
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,81 @@
+import hashlib
+import hmac
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from util.Metrics import get_metrics
+
+
+class PasswordHasher:
+    '''
+    Derives password hashes on a pool of worker threads.
+
+    hashlib releases the GIL while it runs PBKDF2, so the workers hash in
+    parallel and a slow hash only ever holds up the session waiting on it.
+    The pool is sized to the number of cores (HashWorkers) so a burst of
+    logins queues up instead of oversubscribing the CPU.
+
+    The algorithm and cost used for a hash are recorded next to it as a
+    params string, "pbkdf2_sha256$<iterations>$<key length>". Hashes stored
+    before the params were recorded have none and use LEGACY_PARAMS.
+    '''
+
+    ALGORITHM = "pbkdf2_sha256"
+    LEGACY_PARAMS = "pbkdf2_sha256$100000$16"
+
+    def __init__(self, iterations=None, workers=None):
+        self.iterations = iterations or int(os.getenv("HashIterations", "100000"))
+        self.workers = workers or int(os.getenv("HashWorkers", "0")) or os.cpu_count() or 1
+        self.params = self.format_params(self.iterations)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hasher")
+
+    @staticmethod
+    def format_params(iterations, dklen=16):
+        return f"{PasswordHasher.ALGORITHM}${iterations}${dklen}"
+
+    @staticmethod
+    def parse_params(params):
+        algorithm, iterations, dklen = (params or PasswordHasher.LEGACY_PARAMS).split("$")
+        if algorithm != PasswordHasher.ALGORITHM:
+            raise ValueError("Unsupported hash algorithm: " + algorithm)
+        return int(iterations), int(dklen)
+
+    @staticmethod
+    def derive(password, salt, params=None):
+        # runs on the calling thread
+        iterations, dklen = PasswordHasher.parse_params(params)
+        with get_metrics().timer("scheduler_password_hash_seconds"):
+            return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations, dklen=dklen)
+
+    def submit(self, password, salt, params=None):
+        return self.executor.submit(self.derive, password, salt, params or self.params)
+
+    def map(self, passwords_and_salts, params=None):
+        # hash many passwords in parallel; results come back in input order
+        futures = [self.submit(password, salt, params) for password, salt in passwords_and_salts]
+        return [f.result() for f in futures]
+
+    def hash(self, password, salt, params=None):
+        return self.submit(password, salt, params).result()
+
+    def verify(self, password, salt, hash, params=None):
+        calculated_hash = self.submit(password, salt, params or self.LEGACY_PARAMS).result()
+        return hmac.compare_digest(calculated_hash, hash)
+
+    def needs_upgrade(self, params):
+        return (params or self.LEGACY_PARAMS) != self.params
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_hasher():
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = PasswordHasher()
+        return _default
@@ -0,0 +1,67 @@
+import contextvars
+import sys
+
+
+class Session:
+    '''
+    The user logged in on one client. At most one of patient and caregiver
+    is set, since a client is logged in as one user at a time.
+
+    The interactive command line has a single session; the server gives each
+    connection its own. Commands find theirs through current_session().
+    '''
+
+    def __init__(self):
+        self.patient = None
+        self.caregiver = None
+        # session token of the logged-in user, see db/SessionStore.py
+        self.token = None
+        # where the session's command output goes; None for the real stdout
+        self.out = None
+        # (start, end, key of the last row shown) of the last
+        # show_appointments listing, for "show_appointments more"
+        self.appointments_page = None
+
+
+_default = Session()
+_current = contextvars.ContextVar("session")
+
+
+def current_session():
+    return _current.get(_default)
+
+
+def use_session(session):
+    # make session current in this context; pass the result to reset_session
+    return _current.set(session)
+
+
+def reset_session(token):
+    _current.reset(token)
+
+
+class SessionStdout:
+    '''
+    Stands in for sys.stdout so that print() in a command writes to the
+    output of the session running it, even with many sessions running on
+    different threads at once.
+    '''
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        out = current_session().out
+        return (out if out is not None else self.stream).write(text)
+
+    def flush(self):
+        out = current_session().out
+        (out if out is not None else self.stream).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def install_session_stdout():
+    if not isinstance(sys.stdout, SessionStdout):
+        sys.stdout = SessionStdout(sys.stdout)
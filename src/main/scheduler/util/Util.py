@@ -1,4 +1,5 @@
-import hashlib
+import csv
+import datetime
 import os
 
 
@@ -6,12 +7,69 @@ class Util:
     def generate_salt():
         return os.urandom(16)
 
-    def generate_hash(password, salt):
-        key = hashlib.pbkdf2_hmac(
-            'sha256',
-            password.encode('utf-8'),
-            salt,
-            100000,
-            dklen=16
-        )
-        return key
+    # parse a hyphenated mm-dd-yyyy date; raises ValueError if it is not valid
+    def parse_date(date):
+        date_tokens = date.split("-")
+        if len(date_tokens) != 3:
+            raise ValueError("Dates must be in the format mm-dd-yyyy")
+        month = int(date_tokens[0])
+        day = int(date_tokens[1])
+        year = int(date_tokens[2])
+        return datetime.datetime(year, month, day)
+
+    # every date from start to end (inclusive) that falls on one of the given
+    # weekdays, where 0 is Monday; every day if weekdays is None
+    def date_range(start, end, weekdays=None):
+        if end < start:
+            raise ValueError("The end date must not be before the start date")
+        dates = []
+        d = start
+        while d <= end:
+            if weekdays is None or d.weekday() in weekdays:
+                dates.append(d)
+            d += datetime.timedelta(days=1)
+        return dates
+
+    # "daily", "weekdays", "weekends" or a comma-separated list like "mon,wed,fri"
+    def parse_weekdays(spec):
+        names = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+        if spec == "daily":
+            return None
+        if spec == "weekdays":
+            return {0, 1, 2, 3, 4}
+        if spec == "weekends":
+            return {5, 6}
+        weekdays = set()
+        for name in spec.split(","):
+            if name[:3] not in names:
+                raise ValueError("Unknown day of the week: " + name)
+            weekdays.add(names.index(name[:3]))
+        return weekdays
+
+    # the p-th percentile (0-100) of a sorted list, by nearest rank
+    def percentile(sorted_values, p):
+        if not sorted_values:
+            return 0
+        rank = max(int(round(p / 100 * len(sorted_values) + 0.5)) - 1, 0)
+        return sorted_values[min(rank, len(sorted_values) - 1)]
+
+    # yield lists of parse_row(row) for the rows of a csv file, batch_size at
+    # a time. Blank rows and header rows (first cell in header) are skipped,
+    # and so are rows that parse_row rejects with ValueError or IndexError,
+    # reported by line number only.
+    def read_csv_batches(path, batch_size, parse_row, header=()):
+        batch = []
+        with open(path, newline="") as f:
+            for line_number, row in enumerate(csv.reader(f), start=1):
+                if not row or not row[0].strip() or row[0].strip().lower() in header:
+                    continue
+                try:
+                    batch.append(parse_row(row))
+                except (IndexError, ValueError):
+                    print("Skipping line", line_number, "of", path)
+                    continue
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# the scheduler's modules import each other as packages of src/main/scheduler
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "main", "scheduler"))
+
+from db.ConnectionManager import ConnectionManager  # noqa: E402
+from db.Migrations import migrate  # noqa: E402
+
+
+@pytest.fixture
+def sqlite(tmp_path, monkeypatch):
+    # a fresh SQLite database behind ConnectionManager, fully migrated
+    monkeypatch.setenv("DBBackend", "sqlite")
+    monkeypatch.setenv("SQLitePath", str(tmp_path / "scheduler.db"))
+    ConnectionManager.close_pool()
+    migrate(verbose=False)
+    yield ConnectionManager.get_pool()
+    ConnectionManager.close_pool()
@@ -0,0 +1,142 @@
+import datetime
+
+import pytest
+
+import Scheduler
+from db.ConnectionManager import ConnectionManager
+from model.Appointment import Appointment
+from model.Caregiver import Caregiver
+from model.Patient import Patient
+from model.Vaccine import Vaccine
+from util.Session import Session, use_session, reset_session
+
+DAY1 = datetime.date(2030, 1, 1)
+DAY2 = datetime.date(2030, 1, 2)
+
+
+@pytest.fixture
+def booked(sqlite):
+    # c0, c1 and c2 free on day 1, c0 on day 2. p0 is booked with c0 and p2
+    # with c1 on day 1, p1 with c0 on day 2: 7 of 10 doses left.
+    Vaccine.catalog.clear()
+    Vaccine.stripe_counts.clear()
+    Caregiver.availability_cache.clear()
+    Appointment.assignment.reset()
+    Caregiver.save_all([Caregiver(name, salt=b"s" * 16, hash=b"h" * 16) for name in ("c0", "c1", "c2")])
+    Patient.save_all([Patient(name, salt=b"s" * 16, hash=b"h" * 16) for name in ("p0", "p1", "p2")])
+    Caregiver("c0").upload_availabilities([DAY1, DAY2])
+    Caregiver("c1").upload_availabilities([DAY1])
+    Caregiver("c2").upload_availabilities([DAY1])
+    Vaccine.add_doses([("pfizer", 10)])
+    return {
+        "p0": Appointment.reserve("p0", DAY1, "pfizer", "c0").id,
+        "p2": Appointment.reserve("p2", DAY1, "pfizer", "c1").id,
+        "p1": Appointment.reserve("p1", DAY2, "pfizer", "c0").id,
+    }
+
+
+def command(line, patient=None, caregiver=None):
+    # run a command line as the given user; read what it printed with capsys
+    session = Session()
+    session.patient = Patient(patient) if patient else None
+    session.caregiver = Caregiver(caregiver) if caregiver else None
+    token = use_session(session)
+    try:
+        Scheduler.run_command(line)
+    finally:
+        reset_session(token)
+
+
+def appointments():
+    with ConnectionManager() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT PUsername, Username, Time FROM Appointments ORDER BY PUsername")
+        return [(row[0], row[1], row[2]) for row in cursor.fetchall()]
+
+
+def doses():
+    return Vaccine("pfizer", None).get().available_doses
+
+
+class TestCancel:
+    def test_patient_cancels_their_appointment(self, booked, capsys):
+        command("cancel {0}".format(booked["p0"]), patient="p0")
+        assert "Appointment cancelled!" in capsys.readouterr().out
+        assert [a[0] for a in appointments()] == ["p1", "p2"]
+        assert doses() == 8
+
+    def test_caregiver_cancels_their_appointment(self, booked, capsys):
+        command("cancel {0}".format(booked["p2"]), caregiver="c1")
+        assert "Appointment cancelled!" in capsys.readouterr().out
+        assert doses() == 8
+        assert "c1" in Caregiver(None).get_availability(DAY1)
+
+    def test_someone_elses_appointment_is_refused(self, booked, capsys):
+        command("cancel {0}".format(booked["p0"]), patient="p1")
+        command("cancel {0}".format(booked["p0"]), caregiver="c1")
+        out = capsys.readouterr().out
+        assert out.count("No appointment with that ID found") == 2
+        assert len(appointments()) == 3
+        assert doses() == 7
+
+    def test_cancelling_twice_gives_back_once(self, booked, capsys):
+        command("cancel {0}".format(booked["p0"]), patient="p0")
+        command("cancel {0}".format(booked["p0"]), patient="p0")
+        out = capsys.readouterr().out
+        assert "Appointment cancelled!" in out and "Cancellation failed." in out
+        assert doses() == 8
+
+    def test_needs_login_and_a_numeric_id(self, booked, capsys):
+        command("cancel {0}".format(booked["p0"]))
+        command("cancel abc", patient="p0")
+        out = capsys.readouterr().out
+        assert "Please login first!" in out
+        assert "Please enter a valid appointment ID!" in out
+        assert len(appointments()) == 3
+
+
+class TestCancelCaregiver:
+    def test_rebooks_or_cancels(self, booked, capsys):
+        command("cancel_caregiver c0 01-01-2030 01-02-2030", caregiver="c0")
+        out = capsys.readouterr().out
+        # p0 moves to c2, the only caregiver still free on day 1; nobody
+        # else is free on day 2, so p1 is cancelled and their dose given back
+        assert "Patient: p0, 2030-01-01: moved to caregiver c2" in out
+        assert "Patient: p1, 2030-01-02: cancelled, no other caregiver available" in out
+        assert "2 appointments of c0: 1 moved, 1 cancelled" in out
+        assert "Doses given back: pfizer 1" in out
+        assert appointments() == [("p0", "c2", DAY1), ("p2", "c1", DAY1)]
+        assert doses() == 8
+
+    def test_clears_availability_and_pairs(self, booked):
+        moved, cancelled, given_back = Appointment.cancel_caregiver("c0", DAY1, DAY2)
+        assert [(a.patient, a.caregiver) for a in moved] == [("p0", "c2")]
+        assert [a.patient for a in cancelled] == ["p1"]
+        assert given_back == {"pfizer": 1}
+        with ConnectionManager() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM Availabilities WHERE Username = %s", "c0")
+            assert cursor.fetchone()[0] == 0
+            cursor.execute("SELECT COUNT(*) FROM Rebookings")
+            assert cursor.fetchone()[0] == 0
+
+    def test_only_the_caregiver_is_allowed(self, booked, capsys):
+        command("cancel_caregiver c0 01-01-2030 01-02-2030", caregiver="c1")
+        command("cancel_caregiver c0 01-01-2030 01-02-2030", patient="p0")
+        out = capsys.readouterr().out
+        assert "You can only cancel your own appointments!" in out
+        assert "Please login as a caregiver first!" in out
+        assert len(appointments()) == 3
+        assert doses() == 7
+
+    def test_admin_is_allowed(self, booked, capsys, monkeypatch):
+        monkeypatch.setenv("AdminCaregivers", "c2, c1")
+        command("cancel_caregiver c0 01-02-2030", caregiver="c1")
+        assert "1 appointments of c0: 0 moved, 1 cancelled" in capsys.readouterr().out
+        assert doses() == 8
+
+    def test_unknown_caregiver(self, booked, capsys, monkeypatch):
+        monkeypatch.setenv("AdminCaregivers", "c1")
+        command("cancel_caregiver nobody 01-01-2030", caregiver="c1")
+        assert "No such caregiver: nobody" in capsys.readouterr().out
+        assert len(appointments()) == 3
@@ -0,0 +1,288 @@
+import threading
+
+import pytest
+
+import db.ConnectionManager as connection_manager
+from db.ConnectionManager import ConnectionManager, ConnectionPool
+
+
+class FakeConnection:
+    def __init__(self, healthy=True, rollback_fails=False):
+        self.healthy = healthy
+        self.rollback_fails = rollback_fails
+        self.closed = False
+        self.rollbacks = 0
+
+    def cursor(self):
+        if not self.healthy:
+            raise ConnectionError("connection lost")
+        return FakeCursor()
+
+    def rollback(self):
+        self.rollbacks += 1
+        if self.rollback_fails:
+            raise ConnectionError("connection lost")
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCursor:
+    def execute(self, statement, params=None):
+        pass
+
+    def fetchall(self):
+        return [(1,)]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(connection_manager, "time", clock)
+    return clock
+
+
+def make_pool(connections, **kwargs):
+    opened = []
+
+    def connect():
+        conn = connections.pop(0)
+        if isinstance(conn, BaseException):
+            raise conn
+        opened.append(conn)
+        return conn
+    return ConnectionPool(connect, **kwargs), opened
+
+
+class TestCheckout:
+    def test_reuses_released_connection(self):
+        pool, opened = make_pool([FakeConnection(), FakeConnection()])
+        conn = pool.acquire()
+        pool.release(conn)
+        assert pool.acquire() is conn
+        assert len(opened) == 1
+
+    def test_times_out_when_every_connection_is_in_use(self):
+        pool, _ = make_pool([FakeConnection(), FakeConnection()], max_size=1, acquire_timeout=0.05)
+        conn = pool.acquire()
+        with pytest.raises(TimeoutError):
+            pool.acquire()
+        pool.release(conn)
+        assert pool.acquire() is conn
+
+    def test_closed_pool_refuses_checkout(self):
+        pool, _ = make_pool([FakeConnection()])
+        conn = pool.acquire()
+        pool.release(conn)
+        pool.close()
+        assert conn.closed
+        with pytest.raises(RuntimeError):
+            pool.acquire()
+
+
+class TestEviction:
+    def test_idle_connection_is_evicted(self, clock):
+        first, second = FakeConnection(), FakeConnection()
+        pool, _ = make_pool([first, second], idle_timeout=10)
+        pool.release(pool.acquire())
+        clock.now += 11
+        assert pool.acquire() is second
+        assert first.closed
+
+    def test_old_connection_is_evicted(self, clock):
+        first, second = FakeConnection(), FakeConnection()
+        pool, _ = make_pool([first, second], idle_timeout=100, max_lifetime=30, health_check_interval=100)
+        for _ in range(3):
+            clock.now += 5
+            pool.release(pool.acquire())
+        clock.now += 25
+        assert pool.acquire() is second
+        assert first.closed
+
+    def test_unhealthy_connection_is_replaced(self, clock):
+        first, second = FakeConnection(), FakeConnection()
+        pool, _ = make_pool([first, second], health_check_interval=5)
+        pool.release(pool.acquire())
+        first.healthy = False
+        clock.now += 6
+        assert pool.acquire() is second
+        assert first.closed
+
+    def test_recent_connection_skips_health_check(self, clock):
+        conn = FakeConnection()
+        pool, _ = make_pool([conn], health_check_interval=5)
+        pool.release(pool.acquire())
+        conn.healthy = False
+        clock.now += 1
+        assert pool.acquire() is conn
+
+
+class SlowCheckConnection(FakeConnection):
+    # a connection whose health check blocks until released
+    def __init__(self, checking, done):
+        super().__init__()
+        self.checking = checking
+        self.done = done
+
+    def cursor(self):
+        connection = self
+
+        class SlowCursor(FakeCursor):
+            def execute(self, statement, params=None):
+                connection.checking.release()
+                connection.done.wait()
+        return SlowCursor()
+
+
+class TestBound:
+    def test_connections_being_checked_hold_their_slots(self):
+        checking, done = threading.Semaphore(0), threading.Event()
+        first, second = SlowCheckConnection(checking, done), SlowCheckConnection(checking, done)
+        pool, opened = make_pool([first, second, FakeConnection(), FakeConnection()],
+                                 max_size=2, health_check_interval=-1, acquire_timeout=5)
+        conns = [pool.acquire(), pool.acquire()]
+        for conn in conns:
+            pool.release(conn)
+
+        def borrow():
+            pool.release(pool.acquire())
+        threads = [threading.Thread(target=borrow, daemon=True) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        try:
+            # both idle connections are in their health check
+            assert checking.acquire(timeout=5) and checking.acquire(timeout=5)
+            assert pool.in_use() == 2
+            assert pool.size() == 2
+            assert len(opened) == 2
+        finally:
+            done.set()
+        for thread in threads:
+            thread.join(5)
+        assert len(opened) == 2
+        assert pool.in_use() == 0
+
+
+class TestConnectFailure:
+    def test_failed_connect_gives_its_slot_back(self):
+        conn = FakeConnection()
+        pool, _ = make_pool([ConnectionError("refused"), conn], max_size=1, acquire_timeout=0.05)
+        with pytest.raises(ConnectionError):
+            pool.acquire()
+        assert pool.size() == 0
+        assert pool.in_use() == 0
+        assert pool.acquire() is conn
+        assert pool.in_use() == 1
+
+
+class TestRelease:
+    def test_release_rolls_back(self):
+        conn = FakeConnection()
+        pool, _ = make_pool([conn])
+        pool.release(pool.acquire())
+        assert conn.rollbacks == 1
+        assert not conn.closed
+
+    def test_connection_that_cannot_roll_back_is_discarded(self):
+        broken, fresh = FakeConnection(rollback_fails=True), FakeConnection()
+        pool, _ = make_pool([broken, fresh])
+        pool.release(pool.acquire())
+        assert broken.closed
+        assert pool.size() == 0
+        assert pool.acquire() is fresh
+
+    def test_release_with_discard_closes(self):
+        conn = FakeConnection()
+        pool, _ = make_pool([conn])
+        pool.release(pool.acquire(), discard=True)
+        assert conn.closed
+        assert conn.rollbacks == 0
+        assert pool.size() == 0
+
+    def test_uncommitted_work_is_not_handed_on(self, sqlite):
+        conn = sqlite.acquire()
+        conn.cursor().execute("INSERT INTO Vaccines (Name, Doses) VALUES (%s, %d)", ("pfizer", 5))
+        sqlite.release(conn)
+        again = sqlite.acquire()
+        assert again is conn
+        cursor = again.cursor()
+        cursor.execute("SELECT COUNT(*) FROM Vaccines")
+        assert cursor.fetchone()[0] == 0
+        sqlite.release(again)
+
+
+def doses():
+    with ConnectionManager() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT Name, Doses FROM Vaccines ORDER BY Name")
+        return cursor.fetchall()
+
+
+def add_vaccine(name, commit=True):
+    cm = ConnectionManager()
+    conn = cm.create_connection()
+    try:
+        conn.cursor().execute("INSERT INTO Vaccines (Name, Doses) VALUES (%s, %d)", (name, 1))
+        if commit:
+            conn.commit()
+    finally:
+        cm.close_connection()
+
+
+class TestSavepoints:
+    def test_commits_when_the_block_ends(self, sqlite):
+        with ConnectionManager.transaction():
+            add_vaccine("a")
+            add_vaccine("b")
+        assert doses() == [("a", 1), ("b", 1)]
+        assert sqlite.in_use() == 0
+
+    def test_checkouts_share_the_transaction_connection(self, sqlite):
+        with ConnectionManager.transaction():
+            with ConnectionManager() as first, ConnectionManager() as second:
+                assert first.transaction is second.transaction
+            assert sqlite.in_use() == 1
+
+    def test_close_without_commit_drops_only_that_work(self, sqlite):
+        with ConnectionManager.transaction():
+            add_vaccine("a")
+            add_vaccine("b", commit=False)
+            add_vaccine("c")
+        assert doses() == [("a", 1), ("c", 1)]
+
+    def test_rollback_undoes_only_its_own_work(self, sqlite):
+        with ConnectionManager.transaction():
+            add_vaccine("a")
+            cm = ConnectionManager()
+            conn = cm.create_connection()
+            conn.cursor().execute("INSERT INTO Vaccines (Name, Doses) VALUES (%s, %d)", ("b", 1))
+            conn.commit()
+            conn.cursor().execute("INSERT INTO Vaccines (Name, Doses) VALUES (%s, %d)", ("c", 1))
+            conn.rollback()
+            cm.close_connection()
+        assert doses() == [("a", 1), ("b", 1)]
+
+    def test_error_rolls_back_everything_and_calls_back(self, sqlite):
+        rolled_back = []
+        with pytest.raises(ValueError):
+            with ConnectionManager.transaction():
+                add_vaccine("a")
+                ConnectionManager.on_rollback(lambda: rolled_back.append(True))
+                raise ValueError("stop")
+        assert doses() == []
+        assert rolled_back == [True]
+        assert sqlite.in_use() == 0
+
+    def test_transactions_do_not_nest(self, sqlite):
+        with ConnectionManager.transaction():
+            with pytest.raises(RuntimeError):
+                with ConnectionManager.transaction():
+                    pass
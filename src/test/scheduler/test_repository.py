@@ -0,0 +1,89 @@
+import datetime
+
+import pytest
+
+from model.Appointment import Appointment
+from model.Caregiver import Caregiver
+from model.Patient import Patient
+from model.Records import AppointmentRecord, AvailabilityRecord, VaccineRecord
+from model.Repository import Repository
+from model.Vaccine import Vaccine
+
+DAY1 = datetime.date(2030, 1, 1)
+DAY2 = datetime.date(2030, 1, 2)
+DAY3 = datetime.date(2030, 1, 3)
+
+
+@pytest.fixture
+def booked(sqlite):
+    # c0 and c1 free on three days, c2 on the last; p0 booked with c0 on day
+    # 1, p1 with c1 on day 2
+    Vaccine.catalog.clear()
+    Vaccine.stripe_counts.clear()
+    Caregiver.availability_cache.clear()
+    Appointment.assignment.reset()
+    Caregiver.save_all([Caregiver(name, salt=b"s" * 16, hash=b"h" * 16) for name in ("c0", "c1", "c2")])
+    Patient.save_all([Patient(name, salt=b"s" * 16, hash=b"h" * 16) for name in ("p0", "p1", "p2")])
+    Caregiver("c0").upload_availabilities([DAY1, DAY2, DAY3])
+    Caregiver("c1").upload_availabilities([DAY1, DAY2, DAY3])
+    Caregiver("c2").upload_availabilities([DAY3])
+    Vaccine.add_doses([("pfizer", 10), ("moderna", 3)])
+    first = Appointment.reserve("p0", DAY1, "pfizer", "c0")
+    second = Appointment.reserve("p1", DAY2, "moderna", "c1")
+    return first.id, second.id
+
+
+def test_appointments_between(booked):
+    first, second = booked
+    assert list(Repository.appointments_between(DAY1, DAY3, batch_size=1)) == [
+        AppointmentRecord(first, DAY1, "p0", "c0"),
+        AppointmentRecord(second, DAY2, "p1", "c1"),
+    ]
+    assert list(Repository.appointments_between(DAY2, DAY2)) == [AppointmentRecord(second, DAY2, "p1", "c1")]
+    assert list(Repository.appointments_between(DAY3, DAY3)) == []
+
+
+def test_appointments_by_id_skips_missing(booked, monkeypatch):
+    first, second = booked
+    monkeypatch.setattr(Repository, "IN_CHUNK", 1)
+    assert Repository.appointments_by_id([second, first, first, 999]) == {
+        first: AppointmentRecord(first, DAY1, "p0", "c0"),
+        second: AppointmentRecord(second, DAY2, "p1", "c1"),
+    }
+
+
+def test_appointments_for(booked):
+    first, second = booked
+    assert Repository.appointments_for("patient", ["p0", "p2"]) == {
+        "p0": [AppointmentRecord(first, DAY1, "p0", "c0")],
+        "p2": [],
+    }
+    assert Repository.appointments_for("caregiver", ["c1"]) == {"c1": [AppointmentRecord(second, DAY2, "p1", "c1")]}
+
+
+def test_availability_between_leaves_out_booked(booked):
+    assert list(Repository.availability_between(DAY1, DAY2)) == [
+        AvailabilityRecord(DAY1, "c1"),
+        AvailabilityRecord(DAY2, "c0"),
+    ]
+
+
+def test_caregivers_available_between(booked):
+    assert Repository.caregivers_available_between(DAY1, DAY1) == ["c1"]
+    assert Repository.caregivers_available_between(DAY1, DAY3) == ["c0", "c1", "c2"]
+
+
+def test_vaccines(booked):
+    assert Repository.vaccines() == [VaccineRecord("moderna", 2), VaccineRecord("pfizer", 9)]
+    assert Repository.vaccines(["pfizer", "astra"]) == [VaccineRecord("pfizer", 9)]
+
+
+def test_vaccines_count_stripes(booked):
+    Vaccine.set_stripes("pfizer", 3)
+    assert Repository.vaccines(["pfizer"]) == [VaccineRecord("pfizer", 9)]
+
+
+def test_users(booked):
+    users = Repository.users("caregiver", ["c0", "nobody"])
+    assert list(users) == ["c0"]
+    assert users["c0"].salt == b"s" * 16
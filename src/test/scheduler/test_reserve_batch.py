@@ -0,0 +1,85 @@
+import datetime
+
+import pytest
+
+from db.ConnectionManager import ConnectionManager
+from model.Appointment import Appointment
+from model.Caregiver import Caregiver
+from model.Patient import Patient
+from model.Vaccine import Vaccine
+
+DAY1 = datetime.date(2030, 1, 1)
+DAY2 = datetime.date(2030, 1, 2)
+DAY3 = datetime.date(2030, 1, 3)
+
+
+@pytest.fixture
+def stock(sqlite):
+    # c0 and c1 free on day 1, c0 on day 2, nobody on day 3; 3 pfizer and
+    # 1 moderna
+    Vaccine.catalog.clear()
+    Vaccine.stripe_counts.clear()
+    Caregiver.availability_cache.clear()
+    Appointment.assignment.reset()
+    Caregiver.save_all([Caregiver(name, salt=b"s" * 16, hash=b"h" * 16) for name in ("c0", "c1")])
+    Patient.save_all([Patient("p%d" % i, salt=b"s" * 16, hash=b"h" * 16) for i in range(6)])
+    Caregiver("c0").upload_availabilities([DAY1, DAY2])
+    Caregiver("c1").upload_availabilities([DAY1])
+    Vaccine.add_doses([("pfizer", 3), ("moderna", 1)])
+
+
+def doses():
+    return dict(Vaccine._load_all())
+
+
+def booked():
+    with ConnectionManager() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT PUsername, Username, Time, Vaccine FROM Appointments ORDER BY PUsername")
+        return cursor.fetchall()
+
+
+def reason(result):
+    return result if isinstance(result, str) else "booked"
+
+
+def test_mixed_batch(stock):
+    results = Appointment.reserve_batch([
+        ("p0", DAY1, "pfizer"),
+        ("nobody", DAY1, "pfizer"),
+        ("p1", DAY1, "astra"),
+        ("p2", DAY1, "moderna"),
+        ("p3", DAY1, "moderna"),
+        ("p4", DAY3, "pfizer"),
+        ("p5", DAY2, "pfizer"),
+    ])
+    assert [reason(r) for r in results] == [
+        "booked",
+        "No such patient",
+        "No such vaccine",
+        "booked",
+        "Not enough available doses!",
+        "No available caregivers found for that date",
+        "booked",
+    ]
+    assert sorted(r.caregiver for r in results if not isinstance(r, str)) == ["c0", "c0", "c1"]
+    assert {row[0]: (row[1], row[3]) for row in booked()}["p5"] == ("c0", "pfizer")
+    # doses taken for requests that found no caregiver are given back
+    assert doses() == {"moderna": 0, "pfizer": 1}
+
+
+def test_caregivers_run_out(stock):
+    results = Appointment.reserve_batch([("p%d" % i, DAY1, "pfizer") for i in range(3)])
+    assert [reason(r) for r in results] == ["booked", "booked", "No available caregivers found for that date"]
+    assert len({r.caregiver for r in results[:2]}) == 2
+    assert doses()["pfizer"] == 1
+
+
+def test_failed_batch_changes_nothing(stock, monkeypatch):
+    def fail(*args):
+        raise RuntimeError("connection lost")
+    monkeypatch.setattr(Vaccine, "give_back", fail)
+    with pytest.raises(RuntimeError):
+        Appointment.reserve_batch([("p0", DAY1, "pfizer"), ("p1", DAY3, "pfizer")])
+    assert booked() == []
+    assert doses() == {"moderna": 1, "pfizer": 3}
@@ -0,0 +1,62 @@
+import datetime
+
+import pytest
+
+import Scheduler
+from model.Appointment import Appointment
+from model.Caregiver import Caregiver
+from model.Patient import Patient
+from model.Vaccine import Vaccine
+from util.Session import Session, use_session, reset_session
+
+DAYS = [datetime.date(2030, 1, 1) + datetime.timedelta(days=i) for i in range(3)]
+
+
+@pytest.fixture
+def booked(sqlite):
+    # p0 booked with c0 on three days
+    Vaccine.catalog.clear()
+    Vaccine.stripe_counts.clear()
+    Caregiver.availability_cache.clear()
+    Appointment.assignment.reset()
+    Caregiver.save_all([Caregiver("c0", salt=b"s" * 16, hash=b"h" * 16)])
+    Patient.save_all([Patient("p0", salt=b"s" * 16, hash=b"h" * 16)])
+    Caregiver("c0").upload_availabilities(DAYS)
+    Vaccine.add_doses([("pfizer", 10)])
+    for day in DAYS:
+        Appointment.reserve("p0", day, "pfizer", "c0")
+    session = Session()
+    session.patient = Patient("p0")
+    token = use_session(session)
+    yield session
+    reset_session(token)
+
+
+def listed(out):
+    return [line.split()[1] for line in out.splitlines() if line.split() and line.split()[0].isdigit()]
+
+
+def test_pages(booked, capsys, monkeypatch):
+    monkeypatch.setenv("AppointmentsPageSize", "2")
+    Scheduler.run_command("show_appointments")
+    out = capsys.readouterr().out
+    assert listed(out) == ["2030-01-01", "2030-01-02"]
+    assert "More appointments: show_appointments more" in out
+    Scheduler.run_command("show_appointments more")
+    out = capsys.readouterr().out
+    assert listed(out) == ["2030-01-03"]
+    assert "More appointments" not in out
+
+
+def test_page_size_zero_lists_everything(booked, capsys, monkeypatch):
+    monkeypatch.setenv("AppointmentsPageSize", "0")
+    Scheduler.run_command("show_appointments")
+    out = capsys.readouterr().out
+    assert listed(out) == ["2030-01-01", "2030-01-02", "2030-01-03"]
+    assert "More appointments" not in out
+    assert booked.appointments_page is None
+
+
+def test_date_range(booked, capsys):
+    Scheduler.run_command("show_appointments 01-02-2030 01-02-2030")
+    assert listed(capsys.readouterr().out) == ["2030-01-02"]
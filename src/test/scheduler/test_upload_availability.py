@@ -0,0 +1,34 @@
+import pytest
+
+import Scheduler
+from model.Caregiver import Caregiver
+from util.Session import Session, use_session, reset_session
+
+
+@pytest.fixture
+def caregiver(sqlite):
+    Caregiver.availability_cache.clear()
+    Caregiver.save_all([Caregiver("c0", salt=b"s" * 16, hash=b"h" * 16)])
+    session = Session()
+    session.caregiver = Caregiver("c0")
+    token = use_session(session)
+    yield session
+    reset_session(token)
+
+
+def test_weekdays(caregiver, capsys):
+    Scheduler.run_command("upload_availability 01-01-2030 01-07-2030 mon,wed")
+    out = capsys.readouterr().out
+    assert "2 of 2 days added" in out
+
+
+def test_unknown_weekday(caregiver, capsys):
+    Scheduler.run_command("upload_availability 01-01-2030 01-07-2030 mon,xyz")
+    out = capsys.readouterr().out
+    assert "Unknown day of the week: xyz" in out
+    assert "valid date" not in out
+
+
+def test_bad_date(caregiver, capsys):
+    Scheduler.run_command("upload_availability 13-01-2030")
+    assert "Please enter a valid date!" in capsys.readouterr().out
@@ -0,0 +1,101 @@
+import pytest
+
+import model.Vaccine as vaccine_module
+from db.ConnectionManager import ConnectionManager
+from model.Vaccine import Vaccine
+
+
+@pytest.fixture
+def stock(sqlite):
+    Vaccine.catalog.clear()
+    Vaccine.stripe_counts.clear()
+    Vaccine.add_doses([("pfizer", 8)])
+    yield
+    Vaccine.catalog.clear()
+    Vaccine.stripe_counts.clear()
+
+
+def run(action):
+    # action(cursor) in one committed transaction
+    with ConnectionManager() as conn:
+        result = action(conn.cursor())
+        conn.commit()
+        return result
+
+
+def rows():
+    # (Vaccines row doses, [doses of each stripe])
+    def read(cursor):
+        cursor.execute("SELECT Doses FROM Vaccines WHERE Name = %s", "pfizer")
+        base = cursor.fetchone()[0]
+        cursor.execute("SELECT Doses FROM VaccineStripes WHERE Name = %s ORDER BY Stripe", "pfizer")
+        return base, [row[0] for row in cursor.fetchall()]
+    return run(read)
+
+
+def doses():
+    return Vaccine("pfizer", None).get().available_doses
+
+
+def test_set_stripes_spreads_doses(stock):
+    assert Vaccine.set_stripes("pfizer", 3) == 8
+    assert rows() == (0, [3, 3, 2])
+    Vaccine.set_stripes("pfizer", 1)
+    assert rows() == (8, [])
+
+
+def test_striped_take_never_goes_negative(stock):
+    Vaccine.set_stripes("pfizer", 4)
+    results = [run(lambda cursor: Vaccine.take_doses(cursor, "pfizer")) for _ in range(10)]
+    assert results == [True] * 8 + [False] * 2
+    assert rows() == (0, [0, 0, 0, 0])
+
+
+def test_falls_back_to_another_stripe(stock, monkeypatch):
+    Vaccine.set_stripes("pfizer", 2)
+    run(lambda cursor: cursor.execute("UPDATE VaccineStripes SET Doses = 0 WHERE Name = %s AND Stripe = 0", "pfizer"))
+    # always start at the empty stripe
+    monkeypatch.setattr(vaccine_module.random, "randrange", lambda n: 0)
+    assert run(lambda cursor: Vaccine.take_doses(cursor, "pfizer", 3))
+    assert rows() == (0, [0, 1])
+
+
+def test_take_fails_when_no_stripe_has_enough(stock):
+    Vaccine.set_stripes("pfizer", 2)
+    assert not run(lambda cursor: Vaccine.take_doses(cursor, "pfizer", 5))
+    assert rows() == (0, [4, 4])
+
+
+def test_take_up_to_drains_every_stripe(stock):
+    Vaccine.set_stripes("pfizer", 2)
+    assert run(lambda cursor: Vaccine.take_up_to(cursor, "pfizer", 5)) == 5
+    assert run(lambda cursor: Vaccine.take_up_to(cursor, "pfizer", 5)) == 3
+    assert run(lambda cursor: Vaccine.take_up_to(cursor, "pfizer", 5)) == 0
+    assert run(lambda cursor: Vaccine.take_up_to(cursor, "astra", 5)) is None
+    base, stripes = rows()
+    assert base == 0 and min(stripes) == 0
+
+
+def test_take_with_stale_stripe_counts(stock):
+    run(lambda cursor: Vaccine.get_stripe_counts(cursor))
+    # striped by another process: this one's cached counts say unstriped
+    Vaccine.set_stripes("pfizer", 4)
+    Vaccine.stripe_counts.put("all", {})
+    assert run(lambda cursor: Vaccine.take_doses(cursor, "pfizer"))
+    assert doses() == 7
+
+
+def test_give_back(stock):
+    Vaccine.set_stripes("pfizer", 2)
+    run(lambda cursor: Vaccine.take_doses(cursor, "pfizer", 2))
+    run(lambda cursor: Vaccine.give_back(cursor, "pfizer", 2))
+    assert doses() == 8
+    assert rows()[0] == 2
+
+
+def test_decrease_available_doses_checks_stock(stock):
+    vaccine = Vaccine("pfizer", 8)
+    vaccine.decrease_available_doses(8)
+    with pytest.raises(ValueError):
+        vaccine.decrease_available_doses(1)
+    assert doses() == 0